@@ -1,19 +1,52 @@
+import time
+IMPORT_STARTED_AT = time.perf_counter()
+
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from fastapi import Request, Response
 import os
+import stat
 import json
 import uuid
 import shutil
-from typing import List
+import asyncio
+import threading
+import hashlib
+import io
+import random
+import heapq
+import math
+import contextlib
+import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Callable
 from dotenv import load_dotenv
-import google.generativeai as genai
 import PIL.Image
+import PIL.ImageOps
 from pathlib import Path
 import typing_extensions as typing
 import ast
+import re
+import sqlite3
+import sys
+
+if not __package__:
+    # Run as a script (python app/main.py): make the app package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.metrics import Counter, Histogram, METRICS
+from app.resilience import CircuitOpenError, ResilientModelClient
+from app.routing import ModelRoute, ModelRouter
+from app.stores import FileKVStore, SqliteKVStore
+from app.uploads import (ImageSource, SharedUploadReader, UploadLimitMiddleware, image_source_size, iter_image_source,
+                         open_image_source)
 
 # Load environment variables
 load_dotenv()
@@ -25,38 +58,620 @@ app = FastAPI(title="Rubrics Service", description="Generate rubrics from image
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
+# Storage locations. Point STORAGE_ROOT at a shared mount to run several
+# hosts against the same session files and result cache.
+STORAGE_ROOT = os.getenv("STORAGE_ROOT", "app/storage")
+TEMP_DIR = f"{STORAGE_ROOT}/temp"
+RESULT_CACHE_DIR = f"{STORAGE_ROOT}/processed"
+
+# Shared key-value store for cached results and job records:
+# "file" (JSON files under RESULT_CACHE_DIR) or "sqlite" (local stand-in KV)
+SHARED_STORE = os.getenv("SHARED_STORE", "file").lower()
+SHARED_STORE_PATH = os.getenv("SHARED_STORE_PATH", f"{STORAGE_ROOT}/shared.sqlite3")
+
+# Multi-process deployment
+WORKERS = int(os.getenv("WORKERS", "1"))
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "30"))
+
 # Create necessary directories
-os.makedirs("app/storage/temp", exist_ok=True)
-os.makedirs("app/storage/processed", exist_ok=True)
+os.makedirs(TEMP_DIR, exist_ok=True)
+os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
 
 # Configure Gemini API
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME", "gemini-2.5-flash")
 
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY not found in environment variables")
+# Model backend: "gemini" (live API) or "stub" (local fake for load tests and benchmarks)
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini").lower()
+STUB_LATENCY_SECONDS = float(os.getenv("STUB_LATENCY_SECONDS", "0.5"))
+STUB_LATENCY_JITTER_SECONDS = float(os.getenv("STUB_LATENCY_JITTER_SECONDS", "0"))
+STUB_FAILURE_RATE = float(os.getenv("STUB_FAILURE_RATE", "0"))
+STUB_SEED = int(os.getenv("STUB_SEED", "0"))
+
+# Context caching: the subject template is uploaded once per model as a cached
+# context and referenced by handle, instead of being resent with every call.
+# Handles are refreshed when less than CONTEXT_CACHE_REFRESH_SECONDS remain.
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "true").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL_SECONDS = float(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+CONTEXT_CACHE_REFRESH_SECONDS = float(os.getenv("CONTEXT_CACHE_REFRESH_SECONDS", "300"))
+
+# Model routing policy: a JSON list of routes, first match wins, e.g.
+# [{"name": "small-math", "model": "gemini-2.5-flash-lite", "subjects": ["math"],
+#   "max_solution_pages": 1, "max_total_bytes": 2000000, "fallback": "gemini-2.5-flash"},
+#  {"name": "long-chemistry", "model": "gemini-2.5-pro", "subjects": ["chemistry"], "min_solution_pages": 3}]
+# Requests matching no route use MODEL_NAME, falling back to MODEL_FALLBACK_NAME on timeout.
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "[]")
+MODEL_FALLBACK_NAME = os.getenv("MODEL_FALLBACK_NAME")
+MODEL_INPUT_COST_PER_1K = float(os.getenv("MODEL_INPUT_COST_PER_1K", "0"))
+MODEL_OUTPUT_COST_PER_1K = float(os.getenv("MODEL_OUTPUT_COST_PER_1K", "0"))
+
+# Construct the default model's client in a startup task instead of on the first request
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "true").lower() in ("1", "true", "yes")
+# How long /readyz reuses its last backend reachability check
+READINESS_BACKEND_CHECK_SECONDS = float(os.getenv("READINESS_BACKEND_CHECK_SECONDS", "30"))
+
+# Maximum number of rubric generations allowed to run at the same time
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "4"))
+
+# Model call resilience settings
+MODEL_TIMEOUT_SECONDS = float(os.getenv("MODEL_TIMEOUT_SECONDS", "90"))
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "2"))
+MODEL_RETRY_BASE_DELAY = float(os.getenv("MODEL_RETRY_BASE_DELAY", "0.5"))
+MODEL_RETRY_MAX_DELAY = float(os.getenv("MODEL_RETRY_MAX_DELAY", "8"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+MODEL_HEDGE = os.getenv("MODEL_HEDGE", "false").lower() in ("1", "true", "yes")
+# Fixed hedge delay; when unset, hedges fire after the observed p95 latency
+MODEL_HEDGE_AFTER_SECONDS = float(os.getenv("MODEL_HEDGE_AFTER_SECONDS")) if os.getenv("MODEL_HEDGE_AFTER_SECONDS") else None
+
+# Model output that cannot be repaired locally (or whose scores do not add up
+# to the total it states) is regenerated up to this many times
+RUBRIC_MAX_REGENERATIONS = int(os.getenv("RUBRIC_MAX_REGENERATIONS", "1"))
+
+# Result cache settings
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "86400"))
+RESULT_CACHE_DISK = os.getenv("RESULT_CACHE_DISK", "true").lower() in ("1", "true", "yes")
+# Rubrics kept in the shared store; the oldest beyond this are swept (0 = no cap)
+RESULT_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_DISK_MAX_ENTRIES", "10000"))
+
+# Image preprocessing settings (applied before images are sent to the model)
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "true").lower() in ("1", "true", "yes")
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+IMAGE_COLOR_MODE = os.getenv("IMAGE_COLOR_MODE", "color").lower()  # color, grayscale or binary
+IMAGE_BINARY_THRESHOLD = int(os.getenv("IMAGE_BINARY_THRESHOLD", "160"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG, PNG or WEBP
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
 
-genai.configure(api_key=GEMINI_API_KEY)
+# Batch generation limits
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+# Background job settings
+JOB_BACKEND = os.getenv("JOB_BACKEND", "local")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(MAX_CONCURRENT_GENERATIONS)))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", "3600"))
+
+# Temp storage reaper settings
+TEMP_MAX_AGE_SECONDS = float(os.getenv("TEMP_MAX_AGE_SECONDS", "21600"))
+TEMP_QUOTA_BYTES = int(os.getenv("TEMP_QUOTA_BYTES", str(1024 * 1024 * 1024)))
+TEMP_REAPER_INTERVAL_SECONDS = float(os.getenv("TEMP_REAPER_INTERVAL_SECONDS", "300"))
+# Request dirs modified more recently than this are never evicted to meet the quota
+TEMP_MIN_AGE_SECONDS = float(os.getenv("TEMP_MIN_AGE_SECONDS", "300"))
+
+# Upload limits, enforced while the request body is being received
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(15 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(60 * 1024 * 1024)))
+UPLOAD_MAX_PAGES = int(os.getenv("UPLOAD_MAX_PAGES", "20"))
+BATCH_UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("BATCH_UPLOAD_MAX_REQUEST_BYTES", str(300 * 1024 * 1024)))
+BATCH_UPLOAD_MAX_PAGES = int(os.getenv("BATCH_UPLOAD_MAX_PAGES", "200"))
+
+# Per-client admission control for the generation endpoints. Clients are
+# identified by a configured X-API-Key, otherwise by IP. Limits are token
+# buckets (requests per minute plus burst); 0 disables. They are configured
+# for the whole service: each of the WORKERS processes keeps its own buckets
+# and enforces 1/WORKERS of every limit, so the workers together allow the
+# configured rate. The fair queue is likewise per worker, over that worker's
+# MAX_CONCURRENT_GENERATIONS slots.
+# CLIENT_POLICIES maps API keys to overrides, and weight sets a client's share
+# of the model-call slots, e.g.
+# {"key-school-a": {"name": "school-a", "rate_per_minute": 120, "burst": 40, "weight": 4}}
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "30"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+CLIENT_POLICIES = os.getenv("CLIENT_POLICIES", "{}")
+
+# Default for the per-request persist flag. Off by default: images are decoded
+# straight from the spooled upload buffers. When on, uploads are also written to
+# app/storage/temp so /storage/temp can serve previews
+PERSIST_UPLOADS = os.getenv("PERSIST_UPLOADS", "false").lower() in ("1", "true", "yes")
+
+# Preview thumbnails, written next to persisted uploads
+THUMBNAIL_WIDTHS = sorted(int(width) for width in os.getenv("THUMBNAIL_WIDTHS", "160,480").split(",") if width.strip())
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+# Threads writing thumbnails in the background, off the generation path
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+# Preview URLs are unique per request and never change, so browsers may keep them until the reaper does
+PREVIEW_MAX_AGE_SECONDS = int(os.getenv("PREVIEW_MAX_AGE_SECONDS", str(int(TEMP_MAX_AGE_SECONDS))))
 
 # Response schema for rubrics
 class RubricResponse(typing.TypedDict):
     Criteria: str
     score: float
 
-# Gemini model setup
-gemini_flash_exp = genai.GenerativeModel(
-    MODEL_NAME,
-    generation_config=genai.GenerationConfig(
-        response_mime_type="application/json",
-        response_schema=list[RubricResponse]
+class ContextCache:
+    """
+    Cached-context handles for one model, keyed by the text they hold (the
+    subject template), so an edited template gets a fresh handle. Handles
+    are created on first use and TTL-refreshed shortly before they expire.
+    Text the backend refuses to cache (e.g. below its minimum token count)
+    is sent inline until the TTL has passed, then caching is retried.
+    """
+
+    def __init__(self, model_name: str, create: Callable, refresh: Callable, delete: Callable,
+                 ttl_seconds: float, refresh_seconds: float):
+        self.model_name = model_name
+        self._create = create
+        self._refresh = refresh
+        self._delete = delete
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        # key -> (handle or None if uncacheable, expires_at)
+        self._entries = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def handle(self, text: str):
+        """Return a live handle for text, creating or refreshing it as needed, or None to send it inline"""
+        key = self.make_key(text)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # One creation per text at a time; concurrent callers wait and reuse it
+        with key_lock:
+            handle, expires_at = self._entries.get(key, (None, 0.0))
+            now = time.time()
+            if handle is None and now < expires_at:
+                CONTEXT_CACHE_TOTAL.inc(self.model_name, "inline")
+                return None
+            if handle is not None and expires_at - now > self.refresh_seconds:
+                CONTEXT_CACHE_TOTAL.inc(self.model_name, "hit")
+                return handle
+            if handle is not None and expires_at > now:
+                try:
+                    self._refresh(handle, self.ttl_seconds)
+                    self._entries[key] = (handle, now + self.ttl_seconds)
+                    CONTEXT_CACHE_TOTAL.inc(self.model_name, "refreshed")
+                    return handle
+                except Exception as e:
+                    print(f"Error refreshing cached context for {self.model_name}: {e}")
+
+            try:
+                handle = self._create(text, self.ttl_seconds)
+            except Exception as e:
+                print(f"Error creating cached context for {self.model_name}, sending it inline: {e}")
+                self._entries[key] = (None, now + self.ttl_seconds)
+                CONTEXT_CACHE_TOTAL.inc(self.model_name, "failed")
+                return None
+            self._entries[key] = (handle, now + self.ttl_seconds)
+            CONTEXT_CACHE_TOTAL.inc(self.model_name, "created")
+            return handle
+
+    def invalidate(self, text: str):
+        """Forget the handle for text, e.g. after the backend reported it missing"""
+        with self._lock:
+            self._entries.pop(self.make_key(text), None)
+
+    def close(self):
+        """Delete every live handle so the backend stops storing them"""
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        for handle, expires_at in entries.values():
+            if handle is not None and expires_at > time.time():
+                try:
+                    self._delete(handle)
+                except Exception as e:
+                    print(f"Error deleting cached context for {self.model_name}: {e}")
+
+def import_genai():
+    """Import the Gemini SDK on first use; it accounts for most of the app's import time"""
+    import google.generativeai as genai
+    return genai
+
+def is_missing_context_error(e: Exception) -> bool:
+    """True if the backend rejected a call because its cached context no longer exists"""
+    return getattr(e, "code", None) == 404
+
+class GeminiModelBackend:
+    """
+    Live Gemini backend. The API is configured and the model constructed on
+    first use, so importing the app does not need GEMINI_API_KEY. With
+    CONTEXT_CACHE on, the context passed to generate_content is held in a
+    Gemini cached content and the call goes to a model bound to it.
+    """
+
+    def __init__(self, model_name: str, api_key: Optional[str]):
+        self.model_name = model_name
+        self.api_key = api_key
+        self._model = None
+        self._cached_models = {}
+        self._lock = threading.Lock()
+        self.context_cache = ContextCache(
+            model_name,
+            create=self._create_context,
+            refresh=lambda handle, ttl_seconds: handle.update(ttl=datetime.timedelta(seconds=ttl_seconds)),
+            delete=lambda handle: handle.delete(),
+            ttl_seconds=CONTEXT_CACHE_TTL_SECONDS,
+            refresh_seconds=CONTEXT_CACHE_REFRESH_SECONDS
+        ) if CONTEXT_CACHE else None
+
+    @staticmethod
+    def _generation_config():
+        return import_genai().GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=list[RubricResponse]
+        )
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    if not self.api_key:
+                        raise ValueError("GEMINI_API_KEY not found in environment variables")
+                    genai = import_genai()
+                    genai.configure(api_key=self.api_key)
+                    self._model = genai.GenerativeModel(
+                        self.model_name,
+                        generation_config=self._generation_config()
+                    )
+        return self._model
+
+    def _create_context(self, text: str, ttl_seconds: float):
+        self.model  # configures the API key
+        return import_genai().caching.CachedContent.create(
+            model=self.model_name,
+            display_name=f"rubrics-{ContextCache.make_key(text)[:16]}",
+            contents=[text],
+            ttl=datetime.timedelta(seconds=ttl_seconds)
+        )
+
+    def _cached_model(self, handle):
+        with self._lock:
+            if handle.name not in self._cached_models:
+                self._cached_models[handle.name] = import_genai().GenerativeModel.from_cached_content(
+                    handle, generation_config=self._generation_config()
+                )
+            return self._cached_models[handle.name]
+
+    def warm_up(self):
+        """Import the SDK, configure it and construct the model ahead of the first call"""
+        self.model
+
+    def ping(self):
+        """Check the API is reachable with a metadata call that uses no tokens"""
+        self.model
+        import_genai().get_model(f"models/{self.model_name}", request_options={"timeout": 10})
+
+    def generate_content(self, content, context: Optional[str] = None, timeout: Optional[float] = None, **kwargs):
+        if timeout is not None:
+            # Ends the HTTP call itself, not just the caller's wait for it
+            kwargs["request_options"] = {"timeout": timeout}
+        if context is None:
+            return self.model.generate_content(content, **kwargs)
+
+        handle = self.context_cache.handle(context) if self.context_cache else None
+        if handle is not None:
+            try:
+                return self._cached_model(handle).generate_content(content, **kwargs)
+            except Exception as e:
+                if not is_missing_context_error(e):
+                    raise
+                # Expired or deleted server-side: send it inline this once, recreate next call
+                self.context_cache.invalidate(context)
+        return self.model.generate_content([context, *content], **kwargs)
+
+class StubModelError(Exception):
+    """Simulated transient backend failure raised by StubModelBackend"""
+
+    def __init__(self, message: str, code: int = 503):
+        super().__init__(message)
+        self.code = code
+
+class StubModelBackend:
+    """
+    Deterministic local stand-in for the Gemini model. Sleeps for a
+    configurable latency, fails at a configurable rate (with a seeded RNG)
+    and returns a schema-valid list of RubricResponse items whose content
+    depends only on the request's text parts and page count. Cached
+    contexts are simulated in memory, with their tokens reported as
+    cached_content_token_count like the live API.
+    """
+
+    class Usage:
+        def __init__(self, prompt_token_count: int, candidates_token_count: int, cached_content_token_count: int = 0):
+            self.prompt_token_count = prompt_token_count
+            self.candidates_token_count = candidates_token_count
+            self.cached_content_token_count = cached_content_token_count
+
+    class Response:
+        def __init__(self, text: str, usage_metadata=None):
+            self.text = text
+            self.usage_metadata = usage_metadata
+
+    def __init__(self, latency_seconds: float = 0.5, jitter_seconds: float = 0.0,
+                 failure_rate: float = 0.0, seed: int = 0, model_name: str = "stub"):
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # handle name -> (text, expires_at), standing in for server-side cached contents
+        self._contexts = {}
+        self.context_cache = ContextCache(
+            model_name,
+            create=self._create_context,
+            refresh=self._refresh_context,
+            delete=lambda handle: self._contexts.pop(handle, None),
+            ttl_seconds=CONTEXT_CACHE_TTL_SECONDS,
+            refresh_seconds=CONTEXT_CACHE_REFRESH_SECONDS
+        ) if CONTEXT_CACHE else None
+
+    def warm_up(self):
+        pass
+
+    def ping(self):
+        pass
+
+    def _create_context(self, text: str, ttl_seconds: float) -> str:
+        handle = f"cachedContents/stub-{ContextCache.make_key(text)[:16]}-{uuid.uuid4().hex[:8]}"
+        self._contexts[handle] = (text, time.time() + ttl_seconds)
+        return handle
+
+    def _refresh_context(self, handle: str, ttl_seconds: float):
+        if handle not in self._contexts:
+            raise StubModelError(f"Cached content {handle} not found", code=404)
+        self._contexts[handle] = (self._contexts[handle][0], time.time() + ttl_seconds)
+
+    @staticmethod
+    def _sleep(seconds: float, deadline: Optional[float]):
+        """Sleep like a slow call would, giving up at deadline like the live client's timeout"""
+        if deadline is not None and time.monotonic() + seconds > deadline:
+            time.sleep(max(0.0, deadline - time.monotonic()))
+            raise TimeoutError("Stub model call exceeded its timeout")
+        time.sleep(seconds)
+
+    def _draw(self):
+        with self._lock:
+            return self._random.random(), self._random.uniform(-self.jitter_seconds, self.jitter_seconds)
+
+    def rubric_for(self, content) -> List[dict]:
+        """Build the deterministic rubric for a content list"""
+        text_parts = [part for part in content if isinstance(part, str)]
+        pages = len(content) - len(text_parts)
+        seed = int(hashlib.sha256("\0".join(text_parts).encode("utf-8")).hexdigest()[:8], 16)
+        criteria = []
+        for i in range(max(pages, 1) + 1):
+            criteria.append({
+                "Criteria": f"Criterion {i + 1}: correct method and working for step {i + 1}",
+                "score": float((seed >> i) % 3 + 1)
+            })
+        return criteria
+
+    def generate_content(self, content, stream: bool = False, context: Optional[str] = None,
+                         timeout: Optional[float] = None, **kwargs):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        cached_chars = 0
+        if context is not None:
+            handle = self.context_cache.handle(context) if self.context_cache else None
+            text, expires_at = self._contexts.get(handle, (None, 0.0))
+            if handle is not None and expires_at > time.time():
+                cached_chars = len(text)
+            elif handle is not None:
+                # Expired server-side: send it inline this once, recreate next call
+                self.context_cache.invalidate(context)
+            content = [context, *content]
+
+        failure_draw, jitter = self._draw()
+        latency = max(0.0, self.latency_seconds + jitter)
+        text = json.dumps(self.rubric_for(content))
+        # Rough token accounting: ~4 characters per token, 258 tokens per image
+        text_chars = sum(len(part) for part in content if isinstance(part, str))
+        pages = sum(1 for part in content if not isinstance(part, str))
+        usage = self.Usage(text_chars // 4 + 258 * pages, len(text) // 4, cached_chars // 4)
+
+        if failure_draw < self.failure_rate:
+            self._sleep(latency, deadline)
+            raise StubModelError("Simulated model backend failure")
+
+        if not stream:
+            self._sleep(latency, deadline)
+            return self.Response(text, usage)
+
+        def chunks():
+            pieces = [text[i:i + 32] for i in range(0, len(text), 32)]
+            for i, piece in enumerate(pieces):
+                self._sleep(latency / len(pieces), deadline)
+                yield self.Response(piece, usage if i == len(pieces) - 1 else None)
+
+        return chunks()
+
+def create_model_backend(name: str, model_name: str = MODEL_NAME):
+    """Create the model backend selected by MODEL_BACKEND for one model"""
+    if name == "gemini":
+        return GeminiModelBackend(model_name, GEMINI_API_KEY)
+    if name == "stub":
+        return StubModelBackend(
+            latency_seconds=STUB_LATENCY_SECONDS,
+            jitter_seconds=STUB_LATENCY_JITTER_SECONDS,
+            failure_rate=STUB_FAILURE_RATE,
+            seed=STUB_SEED,
+            model_name=model_name
+        )
+    raise ValueError(f"Unknown MODEL_BACKEND: {name}. Must be one of: ['gemini', 'stub']")
+
+STAGE_SECONDS = Histogram("rubrics_stage_duration_seconds", "Time spent in each request stage", ("stage",))
+REQUEST_SECONDS = Histogram("rubrics_http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+REQUESTS_TOTAL = Counter("rubrics_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+CACHE_REQUESTS_TOTAL = Counter("rubrics_cache_requests_total", "Result cache lookups", ("result",))
+ERRORS_TOTAL = Counter("rubrics_errors_total", "Errors by type", ("type",))
+FIRST_CRITERION_SECONDS = Histogram("rubrics_time_to_first_criterion_seconds", "Time until the first streamed criterion")
+METRICS.extend([STAGE_SECONDS, REQUEST_SECONDS, REQUESTS_TOTAL, CACHE_REQUESTS_TOTAL, ERRORS_TOTAL, FIRST_CRITERION_SECONDS])
+
+# Per-request stage timings (in ms) for the Server-Timing header
+request_timings: ContextVar[Optional[dict]] = ContextVar("request_timings", default=None)
+# (client id, scheduling weight) of the request being served, set by RateLimitMiddleware
+request_client: ContextVar[tuple] = ContextVar("request_client", default=("anonymous", 1.0))
+
+@contextmanager
+def stage_timer(stage: str):
+    """Time a request stage into the stage histogram and the Server-Timing header"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        record_stage(stage, elapsed)
+
+def record_stage(stage: str, elapsed: float):
+    """Record an already measured stage duration in seconds"""
+    STAGE_SECONDS.observe(stage, value=elapsed)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed * 1000
+
+def record_error(e: Exception):
+    """Count an error by its exception type"""
+    ERRORS_TOTAL.inc(type(e).__name__)
+
+CONTEXT_CACHE_TOTAL = Counter("rubrics_context_cache_total", "Cached-context lookups by outcome", ("model", "outcome"))
+METRICS.append(CONTEXT_CACHE_TOTAL)
+
+def create_model_client(model_name: str) -> ResilientModelClient:
+    """Create a resilient client for one model on the configured backend"""
+    return ResilientModelClient(
+        create_model_backend(MODEL_BACKEND, model_name),
+        timeout_seconds=MODEL_TIMEOUT_SECONDS,
+        max_retries=MODEL_MAX_RETRIES,
+        base_delay=MODEL_RETRY_BASE_DELAY,
+        max_delay=MODEL_RETRY_MAX_DELAY,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        reset_seconds=CIRCUIT_RESET_SECONDS,
+        hedge=MODEL_HEDGE,
+        hedge_after_seconds=MODEL_HEDGE_AFTER_SECONDS,
+        max_workers=MAX_CONCURRENT_GENERATIONS * 4
     )
+
+RUBRIC_VALIDATION_TOTAL = Counter("rubrics_rubric_validation_total", "Model outputs by validation outcome", ("outcome",))
+METRICS.append(RUBRIC_VALIDATION_TOTAL)
+
+model_router = ModelRouter.from_config(
+    MODEL_ROUTES,
+    ModelRoute("default", MODEL_NAME, fallback=MODEL_FALLBACK_NAME, input_cost_per_1k=MODEL_INPUT_COST_PER_1K,
+               output_cost_per_1k=MODEL_OUTPUT_COST_PER_1K),
+    create_model_client
+)
+
+# Bounded worker pool for the blocking generation path (PIL + Gemini SDK),
+# so slow model calls never run on the event loop
+generation_executor = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_GENERATIONS,
+    thread_name_prefix="rubric-generation"
 )
+# Submitted and not yet finished (queued or running), so shutdown can wait for them
+generation_futures = set()
+
+GENERATION_QUEUE_WAIT_SECONDS = Histogram("rubrics_generation_queue_wait_seconds", "Time spent waiting for a model-call slot")
+METRICS.append(GENERATION_QUEUE_WAIT_SECONDS)
+
+class FairScheduler:
+    """
+    Weighted fair queue in front of the MAX_CONCURRENT_GENERATIONS model-call
+    slots. Each waiting call gets a virtual finish tag one 1/weight step past
+    its client's previous call, and freed slots go to the smallest tag, so a
+    client with many queued calls (e.g. a bulk batch) is interleaved with
+    everyone else instead of being served first-come first-served.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.in_use = 0
+        self._waiting = []
+        self._finish_tags = {}
+        self._virtual_time = 0.0
+        self._sequence = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._waiting if not future.done())
+
+    async def acquire(self, client: str, weight: float = 1.0):
+        """Wait for a slot; calls of the request's client are ordered by their weighted finish tag"""
+        started = time.perf_counter()
+        if self.in_use < self.slots and not self._waiting:
+            self.in_use += 1
+            GENERATION_QUEUE_WAIT_SECONDS.observe(value=0.0)
+            return
+
+        tag = max(self._virtual_time, self._finish_tags.get(client, 0.0)) + 1.0 / max(weight, 0.001)
+        self._finish_tags[client] = tag
+        self._sequence += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (tag, self._sequence, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Granted a slot just as the caller gave up: pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        GENERATION_QUEUE_WAIT_SECONDS.observe(value=time.perf_counter() - started)
+
+    def release(self):
+        """Hand the slot to the waiting call with the smallest finish tag, or free it"""
+        while self._waiting:
+            tag, _, future = heapq.heappop(self._waiting)
+            if future.done():
+                continue
+            self._virtual_time = tag
+            future.set_result(None)
+            return
+        self.in_use -= 1
+        # Clients idle past the virtual clock start over from it anyway
+        if len(self._finish_tags) > 1000:
+            self._finish_tags = {client: tag for client, tag in self._finish_tags.items() if tag > self._virtual_time}
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold a model-call slot on behalf of the current request's client"""
+        client, weight = request_client.get()
+        await self.acquire(client, weight)
+        try:
+            yield
+        finally:
+            self.release()
+
+generation_scheduler = FairScheduler(MAX_CONCURRENT_GENERATIONS)
+
+def run_in_generation_executor(func: Callable, *args):
+    """Run func on the generation worker pool, keeping the caller's context (stage timings)"""
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(generation_executor, copy_context().run, func, *args)
+    generation_futures.add(future)
+    future.add_done_callback(generation_futures.discard)
+    return future
 
 # Load prompts from Python file (dict literal)
+PROMPTS_PATH = "app/prompts/prompts.py"
+
 def load_prompts():
     """Load subject-specific prompts from app/prompts/prompts.py"""
     try:
-        with open("app/prompts/prompts.py", "r", encoding="utf-8") as f:
+        with open(PROMPTS_PATH, "r", encoding="utf-8") as f:
             content = f.read()
         # prompts.py contains a top-level dict literal
         return ast.literal_eval(content)
@@ -65,31 +680,506 @@ def load_prompts():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to load prompts: {e}")
 
-def get_rubric(images: List[str], subject: str = "math") -> List[dict]:
+class PromptRegistry:
     """
-    Generate a detailed grading rubric based on the provided question, solution, and initial rubrics.
-    Args:
-        images (List[str]): A list of image paths containing the question, solution, and initial rubrics.
-        subject (str): The subject for which to generate rubrics (math, physics, chemistry).
+    In-memory cache of the subject prompt templates.
+    prompts.py is parsed once and only re-parsed when its mtime changes.
+    """
+
+    def __init__(self, path: str = PROMPTS_PATH):
+        self.path = path
+        self._prompts = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            if self._prompts:
+                # Keep serving the last good copy if the file disappears
+                return
+            raise HTTPException(status_code=500, detail="prompts.py not found at app/prompts/prompts.py")
+
+        if mtime == self._mtime:
+            return
+
+        with self._lock:
+            if mtime != self._mtime:
+                self._prompts = load_prompts()
+                self._mtime = mtime
+
+    def prompts(self) -> dict:
+        """Return all prompts, reloading first if prompts.py changed"""
+        self._refresh()
+        return self._prompts
+
+    def subjects(self) -> List[str]:
+        """Return the subjects that have a prompt template"""
+        return list(self.prompts().keys())
+
+    def get_template(self, subject: str, name: str = "generate_rubric") -> str:
+        """Return a prompt template for a subject"""
+        prompts = self.prompts()
+        if subject not in prompts:
+            raise HTTPException(status_code=400, detail=f"No prompt template found for subject: {subject}")
+        return prompts[subject][name]
+
+prompt_registry = PromptRegistry()
+
+def create_shared_store(name: str):
+    """Create the shared store selected by SHARED_STORE"""
+    if name == "file":
+        return FileKVStore(RESULT_CACHE_DIR)
+    if name == "sqlite":
+        return SqliteKVStore(SHARED_STORE_PATH)
+    raise ValueError(f"Unknown SHARED_STORE: {name}. Must be one of: ['file', 'sqlite']")
+
+shared_store = create_shared_store(SHARED_STORE)
+
+class RubricCache:
+    """
+    Content-addressed cache of generated rubrics.
+    Entries live in a bounded in-memory LRU with a TTL, and optionally in
+    the shared store so they survive restarts and are shared by workers.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, store=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(images: List[ImageSource], subject: str, template: str, model_name: str, options: str = "") -> str:
+        """Hash the subject, prompt template, model name, options and image bytes"""
+        digest = hashlib.sha256()
+        for part in (subject, template, model_name, options):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        for source in images:
+            for chunk in iter_image_source(source):
+                digest.update(chunk)
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """Return the cached rubric for key, or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        if self.store is None:
+            return None
+
+        try:
+            stored = self.store.get(f"rubric-{key}")
+            if stored is None:
+                return None
+            value = json.loads(stored)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            print(f"Error reading rubric cache entry: {e}")
+            return None
+
+        self._put_memory(key, value, self.ttl_seconds)
+        return value
+
+    def _put_memory(self, key: str, value, ttl_seconds: float):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def put(self, key: str, value):
+        """Store a rubric in memory and, if enabled, in the shared store"""
+        self._put_memory(key, value, self.ttl_seconds)
+
+        if self.store is None:
+            return
+        try:
+            self.store.set(f"rubric-{key}", json.dumps(value), self.ttl_seconds)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error writing rubric cache entry: {e}")
+
+rubric_cache = RubricCache(
+    max_size=RESULT_CACHE_SIZE,
+    ttl_seconds=RESULT_CACHE_TTL_SECONDS,
+    store=shared_store if RESULT_CACHE_DISK else None
+)
+
+class TempStorageReaper:
+    """
+    Evicts request directories under app/storage/temp by age and by a
+    total-bytes quota. Request handlers only rename directories into a
+    trash folder (discard); the actual deletes happen in batches here.
+    Directories still in use carry an ACTIVE_MARKER file, so the reaper of
+    any worker sharing the root skips them (and anything younger than
+    min_age_seconds) when evicting for the quota.
+    """
+
+    TRASH_NAME = ".trash"
+    ACTIVE_MARKER = ".active"
+
+    def __init__(self, root: str, max_age_seconds: float, quota_bytes: int, min_age_seconds: float = 0):
+        self.root = root
+        self.max_age_seconds = max_age_seconds
+        self.quota_bytes = quota_bytes
+        self.min_age_seconds = min_age_seconds
+        self.trash_dir = os.path.join(root, self.TRASH_NAME)
+        self._lock = threading.Lock()
+        self.stats = {
+            "runs": 0,
+            "dirs_reclaimed": 0,
+            "bytes_reclaimed": 0,
+            "last_run_at": None,
+            "last_dirs_reclaimed": 0,
+            "last_bytes_reclaimed": 0,
+            "current_dirs": 0,
+            "current_bytes": 0
+        }
+
+    def open_request_dir(self, request_dir: str):
+        """Create a request directory marked as in use until release()"""
+        os.makedirs(request_dir, exist_ok=True)
+        open(os.path.join(request_dir, self.ACTIVE_MARKER), "a").close()
+
+    def release(self, request_dir: str):
+        """Clear the in-use mark; the directory is then subject to quota eviction"""
+        try:
+            os.remove(os.path.join(request_dir, self.ACTIVE_MARKER))
+        except FileNotFoundError:
+            pass
+
+    def discard(self, request_dir: str):
+        """Move a request directory out of the way; the next reap deletes it"""
+        os.makedirs(self.trash_dir, exist_ok=True)
+        target = os.path.join(self.trash_dir, f"{os.path.basename(request_dir)}-{uuid.uuid4().hex}")
+        try:
+            os.rename(request_dir, target)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _scan_dir(path: str):
+        """Return (total bytes, newest mtime) of a directory tree using os.scandir"""
+        total = 0
+        newest = os.stat(path).st_mtime
+        stack = [path]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        total += st.st_size
+                        newest = max(newest, st.st_mtime)
+        return total, newest
+
+    def reap(self, protected: Optional[set] = None) -> dict:
+        """Evict expired and over-quota request directories, then empty the trash"""
+        protected = protected or set()
+        with self._lock:
+            now = time.time()
+            request_dirs = []
+            try:
+                with os.scandir(self.root) as entries:
+                    for entry in entries:
+                        if entry.name == self.TRASH_NAME or not entry.is_dir(follow_symlinks=False):
+                            continue
+                        try:
+                            size, mtime = self._scan_dir(entry.path)
+                        except FileNotFoundError:
+                            continue
+                        active = os.path.exists(os.path.join(entry.path, self.ACTIVE_MARKER))
+                        request_dirs.append((mtime, size, entry.path, entry.name, active))
+            except FileNotFoundError:
+                return self.stats
+
+            # Oldest first, so quota eviction removes the least recently used
+            request_dirs.sort()
+            total_bytes = sum(size for _, size, _, _, _ in request_dirs)
+            victims = []
+            kept = []
+            for mtime, size, path, name, active in request_dirs:
+                # Age eviction ignores the marker, so one left by a crashed worker cannot pin a dir forever
+                expired = now - mtime > self.max_age_seconds
+                evictable = not active and now - mtime >= self.min_age_seconds
+                over_quota = total_bytes > self.quota_bytes and evictable
+                if name not in protected and (expired or over_quota):
+                    victims.append((size, path))
+                    total_bytes -= size
+                else:
+                    kept.append(size)
+
+            for _, path in victims:
+                self.discard(path)
+
+            reclaimed_bytes = sum(size for size, _ in victims)
+            if os.path.isdir(self.trash_dir):
+                with os.scandir(self.trash_dir) as entries:
+                    trashed = [entry.path for entry in entries]
+                for path in trashed:
+                    shutil.rmtree(path, ignore_errors=True)
+
+            self.stats["runs"] += 1
+            self.stats["dirs_reclaimed"] += len(victims)
+            self.stats["bytes_reclaimed"] += reclaimed_bytes
+            self.stats["last_run_at"] = now
+            self.stats["last_dirs_reclaimed"] = len(victims)
+            self.stats["last_bytes_reclaimed"] = reclaimed_bytes
+            self.stats["current_dirs"] = len(kept)
+            self.stats["current_bytes"] = sum(kept)
+
+            if victims:
+                print(f"Temp reaper reclaimed {len(victims)} request dirs ({reclaimed_bytes} bytes)")
+            return self.stats
+
+temp_reaper = TempStorageReaper(
+    root=TEMP_DIR,
+    max_age_seconds=TEMP_MAX_AGE_SECONDS,
+    quota_bytes=TEMP_QUOTA_BYTES,
+    min_age_seconds=TEMP_MIN_AGE_SECONDS
+)
+
+def preprocessing_signature() -> str:
+    """Describe the active preprocessing settings (part of the result cache key)"""
+    if not IMAGE_PREPROCESS:
+        return "raw"
+    return f"{IMAGE_MAX_EDGE}:{IMAGE_COLOR_MODE}:{IMAGE_BINARY_THRESHOLD}:{IMAGE_FORMAT}:{IMAGE_QUALITY}"
+
+def preprocess_image(image: PIL.Image.Image) -> dict:
+    """
+    Shrink and re-encode a page before it is sent to the model.
+    Fixes EXIF orientation, caps the longest edge at IMAGE_MAX_EDGE, applies
+    IMAGE_COLOR_MODE and re-encodes to IMAGE_FORMAT without metadata.
 
     Returns:
-        List[dict]: A list representing the improved rubric with detailed assessment criteria.
+        dict: {"mime_type", "data"} blob holding the encoded bytes, so the SDK
+        sends them as-is instead of re-encoding a PIL image
     """
-    
-    # Load prompts and get the appropriate template
-    prompts = load_prompts()
-    
-    # Get the subject-specific template
-    if subject.lower() not in prompts:
-        raise HTTPException(status_code=400, detail=f"No prompt template found for subject: {subject}")
-    
-    template = prompts[subject.lower()]["generate_rubric"]
+    image = PIL.ImageOps.exif_transpose(image)
+
+    if IMAGE_COLOR_MODE == "grayscale":
+        image = image.convert("L")
+    elif IMAGE_COLOR_MODE == "binary":
+        image = image.convert("L").point(lambda px: 255 if px > IMAGE_BINARY_THRESHOLD else 0, mode="1")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    if max(image.size) > IMAGE_MAX_EDGE:
+        image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), PIL.Image.Resampling.LANCZOS)
 
+    if IMAGE_FORMAT in ("JPEG", "WEBP") and image.mode == "1":
+        image = image.convert("L")
+
+    # Re-encoding without passing exif= drops all metadata
+    buffer = io.BytesIO()
+    save_kwargs = {"optimize": True}
+    if IMAGE_FORMAT in ("JPEG", "WEBP"):
+        save_kwargs["quality"] = IMAGE_QUALITY
+    image.save(buffer, format=IMAGE_FORMAT, **save_kwargs)
+    return {"mime_type": PIL.Image.MIME[IMAGE_FORMAT], "data": buffer.getvalue()}
+
+def load_images(images: List[ImageSource]) -> List[dict]:
+    """
+    Load every page as a {"mime_type", "data"} blob: preprocessed when
+    IMAGE_PREPROCESS is on, otherwise the uploaded bytes unchanged.
+    """
     img = []
-    for image_path in images:
-        img.append(PIL.Image.open(image_path))
+    original_bytes = 0
+    processed_bytes = 0
+
+    for i, source in enumerate(images):
+        original_bytes += image_source_size(source)
+        try:
+            with open_image_source(source) as original:
+                if IMAGE_PREPROCESS:
+                    blob = preprocess_image(original)
+                    processed_bytes += len(blob["data"])
+                else:
+                    blob = {"mime_type": PIL.Image.MIME[original.format],
+                            "data": b"".join(iter_image_source(source))}
+        except PIL.UnidentifiedImageError:
+            raise HTTPException(status_code=400, detail=f"Image {i + 1} is corrupt or in an unsupported format")
+        except PIL.Image.DecompressionBombError as e:
+            raise HTTPException(status_code=400, detail=f"Image {i + 1} is too large to decode: {e}")
+        img.append(blob)
+
+    if IMAGE_PREPROCESS and original_bytes:
+        saved = original_bytes - processed_bytes
+        print(f"Preprocessed {len(img)} images: {original_bytes} -> {processed_bytes} bytes "
+              f"({saved} bytes saved, {saved * 100 / original_bytes:.1f}%)")
+
+    return img
+
+class RubricStreamParser:
+    """
+    Incremental parser for a streamed JSON array of RubricResponse objects.
+    feed() accepts arbitrary text chunks and returns the objects completed so far.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._started = False
+
+    def feed(self, text: str) -> List[dict]:
+        completed = []
+        for ch in text:
+            if not self._started:
+                if ch == "[":
+                    self._started = True
+                continue
+
+            if self._depth > 0:
+                self._buffer.append(ch)
 
-    # Build the content list for Gemini
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._buffer = [ch]
+                self._depth += 1
+            elif ch == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        completed.append(json.loads("".join(self._buffer)))
+                    except json.JSONDecodeError as e:
+                        print(f"Skipping malformed streamed criterion: {e}")
+                    self._buffer = []
+        return completed
+
+class RubricValidationError(ValueError):
+    """Model output that could not be repaired into a usable rubric"""
+
+    def __init__(self, message: str, rubric: Optional[List[dict]] = None):
+        super().__init__(message)
+        # Best-effort rubric, when one could be recovered despite the error
+        self.rubric = rubric
+
+CRITERIA_KEYS = ("criteria", "criterion", "description")
+SCORE_KEYS = ("score", "marks", "mark", "points")
+# The prompt's "Total Marks: N" line, not a criterion that merely starts with "Total"
+TOTAL_ROW_PATTERN = re.compile(r"^\s*total\s+(marks|score)\b", re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
+
+def parse_score(value) -> Optional[float]:
+    """Read a score given as a number or as text such as "2", "1.5 marks" or "[2]" """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        match = NUMBER_PATTERN.search(value)
+        if match:
+            return float(match.group())
+    return None
+
+def coerce_criterion(item) -> Optional[dict]:
+    """Coerce one model item to RubricResponse, or None if it has no criteria text or score"""
+    if not isinstance(item, dict):
+        return None
+    fields = {str(key).strip().lower(): value for key, value in item.items()}
+    criteria = next((fields[key] for key in CRITERIA_KEYS if key in fields), None)
+    score = next((parse_score(fields[key]) for key in SCORE_KEYS if key in fields), None)
+    if not isinstance(criteria, str) or not criteria.strip() or score is None:
+        return None
+    return {"Criteria": criteria.strip(), "score": score}
+
+def validate_rubric(text: str):
+    """
+    Parse, repair and check a model response against list[RubricResponse]
+    without another model call:
+    - markdown fences, wrapper objects and truncated arrays are tolerated
+      (every complete criterion is kept);
+    - items are coerced to {"Criteria": str, "score": float};
+    - a trailing "Total marks: N" row, or a total field on a wrapper object,
+      is taken as the extracted total and the scores must add up to it.
+
+    Returns:
+        tuple: (rubric, list of repairs applied)
+
+    Raises:
+        RubricValidationError: if no usable rubric remains, or the scores do
+            not match the total (the repaired rubric is attached).
+    """
+    repairs = []
+    total = None
+    stripped = text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    if stripped != text.strip():
+        repairs.append("fenced")
+    try:
+        parsed = json.loads(stripped)
+    except json.JSONDecodeError:
+        # Salvage every complete object, e.g. from a response cut off mid-array
+        parsed = RubricStreamParser().feed(stripped if stripped.startswith("[") else "[" + stripped)
+        repairs.append("truncated")
+
+    if isinstance(parsed, dict):
+        # {"rubric": [...], "total_marks": 10} or a single criterion
+        items = next((value for value in parsed.values() if isinstance(value, list)), None)
+        if items is None:
+            items = [parsed]
+        else:
+            total = next((parse_score(value) for key, value in parsed.items() if "total" in str(key).lower()), None)
+        repairs.append("unwrapped")
+        parsed = items
+    if not isinstance(parsed, list):
+        raise RubricValidationError("Model response is not a list of criteria")
+
+    rubric = []
+    for item in parsed:
+        criterion = coerce_criterion(item)
+        if criterion is None:
+            repairs.append("dropped_item")
+            continue
+        if criterion != item:
+            repairs.append("coerced_item")
+        rubric.append(criterion)
+
+    # A "Total marks" row is the model restating the total, not a criterion
+    criteria = rubric
+    if len(rubric) > 1 and TOTAL_ROW_PATTERN.match(rubric[-1]["Criteria"]):
+        total = rubric[-1]["score"]
+        criteria = rubric[:-1]
+
+    if not criteria:
+        raise RubricValidationError("Model response contains no valid criteria")
+    if total is not None and abs(sum(criterion["score"] for criterion in criteria) - total) > 0.01:
+        # Keep every row in the best-effort rubric: the "total" may have been a real criterion
+        raise RubricValidationError(
+            f"Criterion scores add up to {sum(criterion['score'] for criterion in criteria):g}, not the total of {total:g}",
+            rubric
+        )
+    if criteria is not rubric:
+        repairs.append("total_row")
+    return criteria, sorted(set(repairs))
+
+def build_content(template: str, img: List[dict]) -> list:
+    """Build the content list for Gemini: template, question, rubrics, then solution pages"""
     content = [template, "question", img[0], "rubrics marking scheme", img[1]]
 
     # Add solution pages (from img[2] onwards)
@@ -99,18 +1189,843 @@ def get_rubric(images: List[str], subject: str = "math") -> List[dict]:
         else:
             content.extend([f"solution page {i-1}", img[i]])
 
+    return content
+
+def get_rubric(images: List[ImageSource], subject: str = "math", on_criterion: Optional[Callable[[dict], None]] = None,
+               route: Optional[ModelRoute] = None) -> tuple:
+    """
+    Generate a detailed grading rubric based on the provided question, solution, and initial rubrics.
+    Args:
+        images (List[ImageSource]): Image paths or upload buffers containing the question, solution, and initial rubrics.
+        subject (str): The subject for which to generate rubrics (math, physics, chemistry).
+        on_criterion (callable, optional): If given, the model response is streamed and this is
+            called with each criterion as soon as it has been fully received. A trailing
+            "Total marks" row is held back, and on_criterion(None) signals that the criteria
+            sent so far are discarded because the output is being regenerated.
+        route (ModelRoute, optional): The model route to use; selected by model_router if omitted.
+
+    Returns:
+        tuple: (rubric, validation). validation is "ok", or "total_mismatch" when the
+        scores still disagree with the stated total after regenerating and the
+        rubric is only the best one available.
+    """
+    
+    # Get the subject-specific template from the cached prompt registry
+    with stage_timer("prompt_load"):
+        template = prompt_registry.get_template(subject.lower())
+
+    if route is None:
+        route = model_router.select(subject.lower(), images)
+
+    with stage_timer("image_preprocess"):
+        img = load_images(images)
+
+    # The template leads the content; it goes to the model as a cached context
+    context, *content = build_content(template, img)
+
     # Generate the rubric using Gemini
     try:
-        gemini_response = gemini_flash_exp.generate_content(content)
-        result = json.loads(gemini_response.text)
-        return result
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {e}")
+        with stage_timer("model_call"):
+            if on_criterion is None:
+                gemini_response = model_router.generate_content(route, content, context=context)
+                response_text = gemini_response.text
+            else:
+                parser = RubricStreamParser()
+                chunks = []
+                # A possible "Total marks" row is only sent once another criterion follows it
+                held = None
+                for chunk in model_router.generate_content(route, content, stream=True, context=context):
+                    chunks.append(chunk.text)
+                    for item in parser.feed(chunk.text):
+                        criterion = coerce_criterion(item)
+                        if criterion is None:
+                            continue
+                        if held is not None:
+                            on_criterion(held)
+                            held = None
+                        if TOTAL_ROW_PATTERN.match(criterion["Criteria"]):
+                            held = criterion
+                        else:
+                            on_criterion(criterion)
+                response_text = "".join(chunks)
+
+        for regeneration in range(RUBRIC_MAX_REGENERATIONS + 1):
+            try:
+                with stage_timer("json_decode"):
+                    result, repairs = validate_rubric(response_text)
+                if repairs:
+                    print(f"Repaired model output: {', '.join(repairs)}")
+                RUBRIC_VALIDATION_TOTAL.inc("regenerated" if regeneration else "repaired" if repairs else "valid")
+                return result, "ok"
+            except RubricValidationError as e:
+                print(f"Invalid model output: {e}")
+                if regeneration == RUBRIC_MAX_REGENERATIONS:
+                    raise
+            # Local repair failed: pay for one more model call
+            if on_criterion is not None:
+                on_criterion(None)
+            with stage_timer("model_regenerate"):
+                response_text = model_router.generate_content(route, content, context=context).text
+    except RubricValidationError as e:
+        RUBRIC_VALIDATION_TOTAL.inc("failed")
+        if e.rubric is not None:
+            # Scores disagree with the stated total; still the best rubric available
+            return e.rubric, "total_mismatch"
+        record_error(e)
         raise HTTPException(status_code=500, detail=f"Error processing rubric: {str(e)}")
+    except CircuitOpenError as e:
+        record_error(e)
+        raise HTTPException(status_code=503, detail=str(e))
+    except TimeoutError as e:
+        print(f"Model call timed out: {e}")
+        record_error(e)
+        raise HTTPException(status_code=504, detail=f"Error generating rubric: {str(e)}")
     except Exception as e:
         print(f"Error generating rubric: {e}")
+        record_error(e)
         raise HTTPException(status_code=500, detail=f"Error generating rubric: {str(e)}")
 
+def lookup_cached_rubric(images: List[ImageSource], subject: str):
+    """Return (cache key, cached rubric or None, model route) for a set of images"""
+    with stage_timer("cache_lookup"):
+        route = model_router.select(subject, images)
+        template = prompt_registry.get_template(subject)
+        key = RubricCache.make_key(images, subject, template, route.model, preprocessing_signature())
+        cached = rubric_cache.get(key)
+    CACHE_REQUESTS_TOTAL.inc("hit" if cached is not None else "miss")
+    return key, cached, route
+
+async def get_rubric_async(images: List[ImageSource], subject: str = "math"):
+    """
+    Run get_rubric on the generation worker pool without blocking the event loop.
+    At most MAX_CONCURRENT_GENERATIONS calls run at once; the rest wait here
+    in the weighted fair queue.
+    Repeated uploads are answered from the result cache; only rubrics that
+    passed validation are cached.
+
+    Returns:
+        tuple: (rubric, cache_hit, validation)
+    """
+    key, cached, route = await run_in_threadpool(lookup_cached_rubric, images, subject)
+    if cached is not None:
+        return cached, True, "ok"
+
+    async with generation_scheduler.slot():
+        result, validation = await run_in_generation_executor(get_rubric, images, subject, None, route)
+
+    if validation == "ok":
+        await run_in_threadpool(rubric_cache.put, key, result)
+    return result, False, validation
+
+async def stream_rubric_events(images: List[ImageSource], subject: str, request_id: str, cleanup_dir: Optional[str] = None,
+                               previews: Optional[List[dict]] = None):
+    """
+    Generate a rubric and yield NDJSON events as criteria arrive:
+    start, one criterion event per item, then done (or error). A reset
+    event means the criteria sent so far are discarded (the model output
+    is being regenerated); done.rubric is always the authoritative result.
+    cleanup_dir, if given, is removed when generation fails and released
+    for quota eviction when the stream ends.
+    previews, if given, are sent with the start event.
+    """
+    started = time.perf_counter()
+    first_criterion_ms = None
+
+    def event(payload: dict) -> str:
+        return json.dumps(payload) + "\n"
+
+    index = 0
+
+    def criterion_event(item: Optional[dict]) -> str:
+        nonlocal index, first_criterion_ms
+        if item is None:
+            index = 0
+            return event({"event": "reset"})
+        if first_criterion_ms is None:
+            first_criterion_ms = round((time.perf_counter() - started) * 1000, 1)
+            FIRST_CRITERION_SECONDS.observe(value=first_criterion_ms / 1000)
+        index += 1
+        return event({"event": "criterion", "index": index - 1, "item": item})
+
+    start = {"event": "start", "request_id": request_id, "subject": subject}
+    if previews is not None:
+        start["previews"] = previews
+
+    try:
+        yield event(start)
+        key, cached, route = await run_in_threadpool(lookup_cached_rubric, images, subject)
+        if cached is not None:
+            for index, criterion in enumerate(cached):
+                yield event({"event": "criterion", "index": index, "item": criterion})
+            yield event({"event": "done", "request_id": request_id, "rubric": cached, "cached": True,
+                         "validation": "ok", "time_to_first_criterion_ms": round((time.perf_counter() - started) * 1000, 1)})
+            return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def on_criterion(criterion: Optional[dict]):
+            loop.call_soon_threadsafe(queue.put_nowait, criterion)
+
+        async with generation_scheduler.slot():
+            generation = run_in_generation_executor(get_rubric, images, subject, on_criterion, route)
+            while True:
+                next_item = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({next_item, generation}, return_when=asyncio.FIRST_COMPLETED)
+                if next_item not in done:
+                    next_item.cancel()
+                    break
+                yield criterion_event(next_item.result())
+            result, validation = await generation
+
+        # Flush criteria queued just before the model call returned
+        while not queue.empty():
+            yield criterion_event(queue.get_nowait())
+
+        if validation == "ok":
+            await run_in_threadpool(rubric_cache.put, key, result)
+        yield event({"event": "done", "request_id": request_id, "rubric": result, "cached": False,
+                     "validation": validation, "time_to_first_criterion_ms": first_criterion_ms})
+    except Exception as e:
+        if cleanup_dir and os.path.exists(cleanup_dir):
+            temp_reaper.discard(cleanup_dir)
+        if isinstance(e, HTTPException):
+            yield event({"event": "error", "status_code": e.status_code, "detail": e.detail})
+        else:
+            print(f"Error streaming rubric: {e}")
+            record_error(e)
+            yield event({"event": "error", "status_code": 500, "detail": f"Error processing request: {str(e)}"})
+    finally:
+        if cleanup_dir:
+            temp_reaper.release(cleanup_dir)
+
+def validate_uploads(all_files: List[List[UploadFile]], file_types: List[str]):
+    """Check that every section has images and that every upload is an image"""
+    for file_list, file_type in zip(all_files, file_types):
+        if not file_list:
+            raise HTTPException(status_code=400, detail=f"No {file_type} images provided")
+
+        for i, file in enumerate(file_list):
+            # Validate file type
+            if not file.content_type or not file.content_type.startswith('image/'):
+                raise HTTPException(status_code=400, detail=f"Invalid file type for {file_type} image {i+1}. Must be an image.")
+
+def safe_filename(filename: str) -> str:
+    """Reduce a client-supplied filename to a single safe path component"""
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", os.path.basename(filename or ""))
+    return name.lstrip(".") or "upload"
+
+def thumbnail_path(file_path: str, width: int) -> str:
+    """Location of the preview thumbnail of an upload at the given width"""
+    directory, filename = os.path.split(file_path)
+    return os.path.join(directory, "thumbs", f"{filename}.w{width}.jpg")
+
+# Thumbnails are written once per saved upload, on their own pool so generation never waits for them
+thumbnail_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails")
+
+def write_thumbnails(file_path: str, widths: List[int] = None):
+    """
+    Write JPEG preview thumbnails of a saved upload, once, at each width.
+    Failures are logged; the preview endpoint regenerates missing ones.
+    """
+    widths = widths or THUMBNAIL_WIDTHS
+    try:
+        with PIL.Image.open(file_path) as image:
+            # Let JPEG decode at reduced scale; previews never need full resolution
+            image.draft("RGB", (max(widths), max(widths) * 4))
+            image = PIL.ImageOps.exif_transpose(image)
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = PIL.Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+
+            os.makedirs(os.path.join(os.path.dirname(file_path), "thumbs"), exist_ok=True)
+            # Largest first, so each smaller size is resized from the previous one
+            for width in sorted(widths, reverse=True):
+                if image.width > width:
+                    image = image.resize((width, max(1, round(image.height * width / image.width))), PIL.Image.Resampling.LANCZOS)
+                path = thumbnail_path(file_path, width)
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                image.save(tmp_path, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+                os.replace(tmp_path, path)
+    except (OSError, PIL.Image.DecompressionBombError) as e:
+        print(f"Error writing thumbnails for {file_path}: {e}")
+
+def preview_urls(saved_paths: List[str]) -> List[dict]:
+    """Preview URLs of persisted uploads: the original and each thumbnail width"""
+    previews = []
+    for path in saved_paths:
+        request_id, filename = path.split("/")[-2:]
+        url = f"/storage/temp/{request_id}/{filename}"
+        previews.append({
+            "type": filename.split("_", 1)[0],
+            "url": url,
+            "thumbnails": {str(width): f"{url}?w={width}" for width in THUMBNAIL_WIDTHS}
+        })
+    return previews
+
+def save_uploads(request_dir: str, all_files: List[List[UploadFile]], file_types: List[str]) -> List[str]:
+    """Write validated uploads to the request directory and queue their preview thumbnails"""
+    saved_paths = []
+
+    for file_list, file_type in zip(all_files, file_types):
+        type_paths = []
+        for i, file in enumerate(file_list):
+            # Save file
+            file_path = f"{request_dir}/{file_type}_{i+1}_{safe_filename(file.filename)}"
+            with open(file_path, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
+            thumbnail_executor.submit(write_thumbnails, file_path)
+            type_paths.append(file_path)
+
+        saved_paths.extend(type_paths)
+
+    return saved_paths
+
+def parse_batch_manifest(manifest: str, default_subject: Optional[str]) -> List[dict]:
+    """
+    Parse and validate the JSON manifest of a batch request.
+    Each item names its subject and the uploaded filenames for each section:
+        [{"id": "q1", "subject": "math", "question": ["q1.png"],
+          "rubrics": ["r1.png"], "solution": ["s1a.png", "s1b.png"]}, ...]
+    """
+    try:
+        items = json.loads(manifest)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid manifest JSON: {e}")
+
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="Manifest must be a non-empty JSON list")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many batch items. Maximum is {BATCH_MAX_ITEMS}")
+
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail=f"Manifest item {index+1} must be an object")
+        parsed.append({
+            "id": str(item.get("id", index + 1)),
+            "subject": str(item.get("subject") or default_subject or "").lower(),
+            "question": item.get("question") or [],
+            "rubrics": item.get("rubrics") or [],
+            "solution": item.get("solution") or [],
+        })
+    return parsed
+
+def resolve_batch_item(item: dict, sources: dict, valid_subjects: List[str]) -> List[ImageSource]:
+    """Map a manifest item's filenames to image sources in question, rubrics, solution order"""
+    if item["subject"] not in valid_subjects:
+        raise HTTPException(status_code=400, detail=f"Invalid subject. Must be one of: {valid_subjects}")
+
+    item_sources = []
+    for file_type in ("question", "rubrics", "solution"):
+        filenames = item[file_type]
+        if not isinstance(filenames, list) or not filenames:
+            raise HTTPException(status_code=400, detail=f"No {file_type} images provided")
+        for filename in filenames:
+            if filename not in sources:
+                raise HTTPException(status_code=400, detail=f"Uploaded file not found for {file_type} image: {filename}")
+            source = sources[filename]
+            # In-memory uploads get a private reader per item so concurrent
+            # items can share an upload without racing on the file position
+            item_sources.append(source if isinstance(source, str) else SharedUploadReader(*source))
+    return item_sources
+
+def read_batch_uploads(files: List[UploadFile], request_dir: Optional[str]) -> dict:
+    """
+    Save batch uploads to request_dir, keyed by filename. Without request_dir
+    the spooled upload buffers are kept as they are, each with a lock for
+    the readers that share it.
+    """
+    sources = {}
+    for i, file in enumerate(files):
+        if not file.content_type or not file.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail=f"Invalid file type for upload {i+1}. Must be an image.")
+        if file.filename in sources:
+            raise HTTPException(status_code=400, detail=f"Duplicate upload filename: {file.filename}")
+
+        if request_dir:
+            file_path = f"{request_dir}/{i+1}_{safe_filename(file.filename)}"
+            with open(file_path, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
+            thumbnail_executor.submit(write_thumbnails, file_path)
+            sources[file.filename] = file_path
+        else:
+            sources[file.filename] = (file.file, threading.Lock())
+    return sources
+
+class LocalJobQueue:
+    """
+    In-process job queue: a bounded asyncio queue drained by a fixed number
+    of worker tasks. Finished jobs are kept for JOB_RESULT_TTL_SECONDS.
+    Job records are mirrored to the shared store so any worker process can
+    answer status polls. Other backends only need to provide
+    start/stop/submit/get/active_job_ids.
+    """
+
+    def __init__(self, workers: int, max_queued: int, result_ttl_seconds: float, store=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.result_ttl_seconds = result_ttl_seconds
+        self.store = store
+        self._jobs = {}
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_seconds: float = 0):
+        """Stop the workers, first letting queued and running jobs finish for up to drain_seconds"""
+        if self._queue is not None and drain_seconds > 0 and self.active_job_ids():
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=drain_seconds)
+            except asyncio.TimeoutError:
+                print(f"Stopping job workers with {len(self.active_job_ids())} jobs unfinished")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _purge_expired(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] and now - job["finished_at"] > self.result_ttl_seconds
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    async def _save(self, job: dict):
+        """Mirror a job record to the shared store"""
+        if self.store is None:
+            return
+        # Unfinished jobs are kept long enough to finish; finished ones for the result TTL
+        ttl_seconds = self.result_ttl_seconds if job["finished_at"] else self.result_ttl_seconds + 86400
+        try:
+            await run_in_threadpool(self.store.set, f"job-{job['job_id']}", json.dumps(job), ttl_seconds)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error saving job {job['job_id']}: {e}")
+
+    async def submit(self, job_id: str, subject: str, images: List[ImageSource], cleanup_dir: Optional[str] = None) -> dict:
+        """Queue a rubric generation job and return its status record"""
+        self._purge_expired()
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "subject": subject,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "rubric": None,
+            "cached": None,
+            "validation": None,
+            "error": None
+        }
+        try:
+            self._queue.put_nowait((job, images, cleanup_dir, request_client.get()))
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Job queue is full. Please retry later.")
+        self._jobs[job_id] = job
+        await self._save(job)
+        return job
+
+    def active_job_ids(self) -> set:
+        """Return the ids of queued and running jobs"""
+        return {job_id for job_id, job in self._jobs.items() if job["finished_at"] is None}
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        """Return the status record of a job, or None if unknown or expired"""
+        self._purge_expired()
+        job = self._jobs.get(job_id)
+        if job is not None or self.store is None:
+            return job
+
+        # The job may belong to another worker process
+        try:
+            stored = await run_in_threadpool(self.store.get, f"job-{job_id}")
+        except (OSError, ValueError, sqlite3.Error):
+            return None
+        return json.loads(stored) if stored else None
+
+    async def _worker(self):
+        while True:
+            job, images, cleanup_dir, client = await self._queue.get()
+            # Jobs are scheduled as the client that submitted them
+            request_client.set(client)
+            job["status"] = "running"
+            job["started_at"] = time.time()
+            await self._save(job)
+            try:
+                job["rubric"], job["cached"], job["validation"] = await get_rubric_async(images, job["subject"])
+                job["status"] = "completed"
+            except Exception as e:
+                job["status"] = "failed"
+                job["error"] = e.detail if isinstance(e, HTTPException) else f"Error processing request: {str(e)}"
+                if cleanup_dir and os.path.exists(cleanup_dir):
+                    temp_reaper.discard(cleanup_dir)
+            finally:
+                if cleanup_dir:
+                    temp_reaper.release(cleanup_dir)
+                job["finished_at"] = time.time()
+                await self._save(job)
+                self._queue.task_done()
+
+JOB_BACKENDS = {
+    "local": LocalJobQueue
+}
+
+if JOB_BACKEND not in JOB_BACKENDS:
+    raise ValueError(f"Unknown JOB_BACKEND: {JOB_BACKEND}. Must be one of: {list(JOB_BACKENDS)}")
+
+job_queue = JOB_BACKENDS[JOB_BACKEND](
+    workers=JOB_WORKERS,
+    max_queued=JOB_QUEUE_SIZE,
+    result_ttl_seconds=JOB_RESULT_TTL_SECONDS,
+    store=shared_store
+)
+
+@app.on_event("startup")
+def load_prompt_registry():
+    """Parse the prompt templates once before serving requests"""
+    model_router.validate_subjects(prompt_registry.subjects())
+
+@app.on_event("startup")
+def start_job_queue():
+    """Start the background job workers"""
+    job_queue.start()
+
+@app.on_event("shutdown")
+async def stop_job_queue():
+    """Stop the background job workers, letting in-flight jobs finish first"""
+    await job_queue.stop(drain_seconds=SHUTDOWN_DRAIN_SECONDS)
+
+async def run_temp_reaper():
+    """
+    Reap temp storage and sweep expired and excess shared-store entries
+    (cached rubrics, job records) now and then every TEMP_REAPER_INTERVAL_SECONDS
+    """
+    while True:
+        try:
+            await run_in_threadpool(temp_reaper.reap, job_queue.active_job_ids())
+        except Exception as e:
+            print(f"Error reaping temp storage: {e}")
+        try:
+            removed = await run_in_threadpool(shared_store.sweep, "rubric-", RESULT_CACHE_DISK_MAX_ENTRIES)
+            if removed:
+                print(f"Swept {removed} expired or excess shared store entries")
+        except Exception as e:
+            print(f"Error sweeping shared store: {e}")
+        await asyncio.sleep(TEMP_REAPER_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+def start_temp_reaper():
+    """Start the periodic temp storage reaper"""
+    app.state.temp_reaper_task = asyncio.create_task(run_temp_reaper())
+
+async def warm_up_model():
+    """Import the model SDK and construct the default client off the event loop"""
+    started = time.perf_counter()
+    try:
+        await run_in_threadpool(model_router.warm_up)
+    except Exception as e:
+        app.state.warmup_error = f"{type(e).__name__}: {e}"
+        print(f"Model warm-up failed: {app.state.warmup_error}")
+    app.state.warmup_seconds = time.perf_counter() - started
+
+@app.on_event("startup")
+def start_model_warmup():
+    """Warm the model client in the background; /readyz reports not ready until it is done"""
+    print(f"App imported in {IMPORT_SECONDS:.3f}s")
+    app.state.warmup_seconds = None
+    app.state.warmup_error = None
+    app.state.warmup_task = asyncio.create_task(warm_up_model()) if MODEL_WARMUP else None
+
+@app.on_event("shutdown")
+async def stop_temp_reaper():
+    """Stop the periodic temp storage reaper"""
+    app.state.temp_reaper_task.cancel()
+    await asyncio.gather(app.state.temp_reaper_task, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def shutdown_thumbnail_executor():
+    """Drop queued thumbnails; the preview endpoint writes any that are missing"""
+    thumbnail_executor.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def shutdown_generation_executor():
+    """Stop the generation worker pool once queued and in-flight generations have drained"""
+    if generation_futures:
+        _, pending = await asyncio.wait(set(generation_futures), timeout=SHUTDOWN_DRAIN_SECONDS)
+        if pending:
+            print(f"Shutting down with {len(pending)} rubric generations still running")
+    generation_executor.shutdown(wait=False)
+
+@app.on_event("shutdown")
+async def release_context_caches():
+    """Delete this process's cached contexts instead of paying to store them until they expire"""
+    await run_in_threadpool(model_router.release_contexts)
+
+app.add_middleware(UploadLimitMiddleware, max_file_bytes=UPLOAD_MAX_FILE_BYTES, limits={
+    "/api/generate": (UPLOAD_MAX_REQUEST_BYTES, UPLOAD_MAX_PAGES),
+    "/api/generate/stream": (UPLOAD_MAX_REQUEST_BYTES, UPLOAD_MAX_PAGES),
+    "/api/jobs": (UPLOAD_MAX_REQUEST_BYTES, UPLOAD_MAX_PAGES),
+    "/api/generate/batch": (BATCH_UPLOAD_MAX_REQUEST_BYTES, BATCH_UPLOAD_MAX_PAGES),
+})
+
+RATE_LIMITED_TOTAL = Counter("rubrics_rate_limited_total", "Requests rejected by the per-client rate limit", ("path",))
+METRICS.append(RATE_LIMITED_TOTAL)
+
+class ClientPolicy:
+    """Rate limit and scheduling weight of one client"""
+
+    def __init__(self, name: Optional[str] = None, rate_per_minute: float = RATE_LIMIT_PER_MINUTE,
+                 burst: float = RATE_LIMIT_BURST, weight: float = 1.0):
+        self.name = name
+        self.rate_per_minute = rate_per_minute
+        self.burst = max(burst, 1.0)
+        self.weight = weight
+
+    def per_worker(self, workers: int) -> "ClientPolicy":
+        """This policy's share for one of workers processes that each keep their own buckets"""
+        workers = max(workers, 1)
+        return ClientPolicy(self.name, self.rate_per_minute / workers, self.burst / workers, self.weight)
+
+class TokenBucketLimiter:
+    """
+    Per-client token buckets. Each admitted request takes one token; a
+    bucket refills at rate_per_minute up to burst. charge() may take a
+    bucket below zero (e.g. for the items of a batch), so the client waits
+    off that debt before its next request is admitted.
+    """
+
+    def __init__(self, policies: dict, default_policy: ClientPolicy):
+        self.policies = policies
+        self.default_policy = default_policy
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, policies_json: str, workers: int = 1) -> "TokenBucketLimiter":
+        """Build the limiter for one of workers processes, each enforcing its share of the limits"""
+        try:
+            entries = json.loads(policies_json)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid CLIENT_POLICIES JSON: {e}")
+        if not isinstance(entries, dict):
+            raise ValueError("CLIENT_POLICIES must be a JSON object keyed by API key")
+        policies = {key: ClientPolicy(**entry).per_worker(workers) for key, entry in entries.items()}
+        return cls(policies, ClientPolicy().per_worker(workers))
+
+    def identify(self, api_key: Optional[str], client_ip: Optional[str]):
+        """
+        Return (client id, policy). Unknown API keys fall back to the IP, so
+        a client cannot dodge its limit by sending fresh keys.
+        """
+        policy = self.policies.get(api_key) if api_key else None
+        if policy is not None:
+            return f"key:{policy.name or hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]}", policy
+        return f"ip:{client_ip or 'unknown'}", self.default_policy
+
+    def _refill(self, client: str, policy: ClientPolicy, now: float) -> float:
+        tokens, updated = self._buckets.get(client, (policy.burst, now))
+        return min(policy.burst, tokens + (now - updated) * policy.rate_per_minute / 60)
+
+    def acquire(self, client: str, policy: ClientPolicy) -> Optional[float]:
+        """Take one token; returns None if admitted, else the seconds until one is available"""
+        if policy.rate_per_minute <= 0:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            tokens = self._refill(client, policy, now)
+            if tokens < 1:
+                self._buckets[client] = (tokens, now)
+                return (1 - tokens) * 60 / policy.rate_per_minute
+            self._buckets[client] = (tokens - 1, now)
+            if len(self._buckets) > 10000:
+                self._purge(now)
+            return None
+
+    def charge(self, client: str, policy: ClientPolicy, cost: float):
+        """Take cost more tokens from an admitted client, going into debt if needed"""
+        if policy.rate_per_minute <= 0 or cost <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._buckets[client] = (self._refill(client, policy, now) - cost, now)
+
+    def _purge(self, now: float):
+        # Buckets that have refilled completely carry no state worth keeping
+        self._buckets = {
+            client: (tokens, updated) for client, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * self.default_policy.rate_per_minute / 60 < self.default_policy.burst
+        }
+
+rate_limiter = TokenBucketLimiter.from_config(CLIENT_POLICIES, WORKERS)
+
+class RateLimitMiddleware:
+    """
+    ASGI middleware that admits requests to the generation endpoints through
+    the client's token bucket, answering 429 with Retry-After before the
+    upload is read, and tags the request with its client for fair scheduling.
+    """
+
+    def __init__(self, app, paths: set):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope.get("path") not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        api_key = headers.get(b"x-api-key", b"").decode("latin-1") or None
+        client_ip = scope["client"][0] if scope.get("client") else None
+        client, policy = rate_limiter.identify(api_key, client_ip)
+
+        retry_after = rate_limiter.acquire(client, policy)
+        if retry_after is not None:
+            RATE_LIMITED_TOTAL.inc(scope["path"])
+            seconds = math.ceil(retry_after)
+            response = JSONResponse(
+                {"detail": f"Rate limit exceeded. Retry after {seconds} seconds"},
+                status_code=429,
+                headers={"Retry-After": str(seconds)}
+            )
+            await response(scope, receive, send)
+            return
+
+        request_client.set((client, policy.weight))
+        scope.setdefault("state", {})["client_policy"] = policy
+        await self.app(scope, receive, send)
+
+app.add_middleware(RateLimitMiddleware, paths={"/api/generate", "/api/generate/stream", "/api/generate/batch", "/api/jobs"})
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Record request latency and attach a Server-Timing header with per-stage timings"""
+    request.state.received_at = time.perf_counter()
+    timings = {}
+    request_timings.set(timings)
+
+    response = await call_next(request)
+
+    elapsed = time.perf_counter() - request.state.received_at
+    route = request.scope.get("route")
+    route_path = route.path if route is not None else "unmatched"
+    REQUEST_SECONDS.observe(request.method, route_path, value=elapsed)
+    REQUESTS_TOTAL.inc(request.method, route_path, str(response.status_code))
+
+    server_timing = [f"{stage};dur={duration:.1f}" for stage, duration in timings.items()]
+    server_timing.append(f"total;dur={elapsed * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(server_timing)
+    return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Expose counters and histograms in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    # Temp storage usage as reported by the last reaper run
+    for name, documentation, key in (
+        ("rubrics_temp_storage_bytes", "Bytes held in app/storage/temp", "current_bytes"),
+        ("rubrics_temp_storage_dirs", "Request directories in app/storage/temp", "current_dirs"),
+        ("rubrics_temp_reclaimed_bytes_total", "Bytes reclaimed by the temp reaper", "bytes_reclaimed"),
+        ("rubrics_temp_reclaimed_dirs_total", "Request directories reclaimed by the temp reaper", "dirs_reclaimed"),
+    ):
+        metric_type = "counter" if name.endswith("_total") else "gauge"
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}", f"{name} {temp_reaper.stats[key]}"])
+
+    # Model-call slots and the fair queue in front of them
+    for name, documentation, value in (
+        ("rubrics_generation_queue_depth", "Generations waiting for a model-call slot", generation_scheduler.queue_depth),
+        ("rubrics_generation_slots_in_use", "Model-call slots in use", generation_scheduler.in_use),
+    ):
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {value}"])
+
+    # Cold-start cost of this process
+    for name, documentation, value in (
+        ("rubrics_import_seconds", "Time taken to import the app module", IMPORT_SECONDS),
+        ("rubrics_warmup_seconds", "Time taken to warm up the model client", getattr(app.state, "warmup_seconds", None)),
+    ):
+        if value is not None:
+            lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {value}"])
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+backend_check = {"checked_at": None, "error": None}
+
+def check_backend() -> Optional[str]:
+    """Return why the model backend is unreachable, rechecking at most every READINESS_BACKEND_CHECK_SECONDS"""
+    now = time.monotonic()
+    if backend_check["checked_at"] is None or now - backend_check["checked_at"] > READINESS_BACKEND_CHECK_SECONDS:
+        try:
+            model_router.ping()
+            backend_check["error"] = None
+        except Exception as e:
+            backend_check["error"] = f"{type(e).__name__}: {e}"
+        backend_check["checked_at"] = now
+    return backend_check["error"]
+
+def check_storage() -> Optional[str]:
+    """Return why temp storage or the shared store cannot be written"""
+    probe = f"readyz-{os.getpid()}"
+    try:
+        probe_path = os.path.join(TEMP_DIR, f".{probe}")
+        with open(probe_path, "w", encoding="utf-8") as f:
+            f.write("ok")
+        os.remove(probe_path)
+        shared_store.set(probe, "ok", 60)
+        if shared_store.get(probe) != "ok":
+            return "Shared store did not return the probe value"
+        shared_store.delete(probe)
+    except (OSError, sqlite3.Error) as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: the process is up and its event loop is responsive
+    """
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: prompts loaded, storage writable, model client warmed up and
+    the backend reachable. Answers 503 with the failing checks otherwise.
+    """
+    checks = {}
+    try:
+        subjects = prompt_registry.subjects()
+        checks["prompts"] = None if subjects else "No subject prompts loaded"
+    except Exception as e:
+        checks["prompts"] = f"{type(e).__name__}: {e}"
+    checks["storage"] = await run_in_threadpool(check_storage)
+
+    warmup_task = getattr(app.state, "warmup_task", None)
+    if warmup_task is not None and not warmup_task.done():
+        checks["warmup"] = "Model client is still warming up"
+    else:
+        checks["warmup"] = getattr(app.state, "warmup_error", None)
+    checks["backend"] = await run_in_threadpool(check_backend)
+
+    ready = all(error is None for error in checks.values())
+    return JSONResponse(
+        {"status": "ready" if ready else "not ready", "checks": {name: error or "ok" for name, error in checks.items()}},
+        status_code=200 if ready else 503
+    )
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     """Serve the main UI page"""
@@ -118,91 +2033,339 @@ async def read_root(request: Request):
 
 @app.post("/api/generate")
 async def generate_rubric(
+    request: Request,
     subject: str = Form(...),
     question_images: List[UploadFile] = File(...),
     rubrics_images: List[UploadFile] = File(...),
-    solution_images: List[UploadFile] = File(...)
+    solution_images: List[UploadFile] = File(...),
+    persist: Optional[bool] = Form(None)
 ):
     """
-    Generate rubric from uploaded images
+    Generate rubric from uploaded images.
+    Set persist=true to keep the uploads in temp storage for preview;
+    otherwise they are read straight from the upload buffers.
     """
+    # Everything between receiving the request and entering the handler is body parsing
+    record_stage("multipart_parse", time.perf_counter() - request.state.received_at)
+
     # Validate subject
-    valid_subjects = ["math", "physics", "chemistry"]
+    valid_subjects = prompt_registry.subjects()
     if subject.lower() not in valid_subjects:
         raise HTTPException(status_code=400, detail=f"Invalid subject. Must be one of: {valid_subjects}")
     
+    all_files = [question_images, rubrics_images, solution_images]
+    file_types = ["question", "rubrics", "solution"]
+    validate_uploads(all_files, file_types)
+    
+    if persist is None:
+        persist = PERSIST_UPLOADS
+    
     # Generate unique request ID
     request_id = str(uuid.uuid4())
-    request_dir = f"app/storage/temp/{request_id}"
-    os.makedirs(request_dir, exist_ok=True)
+    request_dir = f"{TEMP_DIR}/{request_id}"
     
     try:
-        # Validate and save files
-        all_files = [question_images, rubrics_images, solution_images]
-        file_types = ["question", "rubrics", "solution"]
-        saved_paths = []
-        
-        for file_list, file_type in zip(all_files, file_types):
-            if not file_list:
-                raise HTTPException(status_code=400, detail=f"No {file_type} images provided")
-            
-            type_paths = []
-            for i, file in enumerate(file_list):
-                # Validate file type
-                if not file.content_type or not file.content_type.startswith('image/'):
-                    raise HTTPException(status_code=400, detail=f"Invalid file type for {file_type} image {i+1}. Must be an image.")
-                
-                # Save file
-                file_path = f"{request_dir}/{file_type}_{i+1}_{file.filename}"
-                with open(file_path, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
-                type_paths.append(file_path)
-            
-            saved_paths.extend(type_paths)
+        if persist:
+            # Save files off the event loop
+            temp_reaper.open_request_dir(request_dir)
+            with stage_timer("upload_save"):
+                image_sources = await run_in_threadpool(save_uploads, request_dir, all_files, file_types)
+        else:
+            image_sources = [file.file for file_list in all_files for file in file_list]
         
         # Generate rubric using the notebook logic
-        rubric_result = get_rubric(saved_paths, subject.lower())
+        rubric_result, cache_hit, validation = await get_rubric_async(image_sources, subject.lower())
         
-        return {
+        response = {
             "request_id": request_id,
             "rubric": rubric_result,
-            "subject": subject
+            "subject": subject,
+            "cached": cache_hit,
+            "validation": validation
         }
+        if persist:
+            response["previews"] = preview_urls(image_sources)
+        return response
         
     except Exception as e:
         # Clean up on error
         if os.path.exists(request_dir):
-            shutil.rmtree(request_dir)
+            temp_reaper.discard(request_dir)
+        if isinstance(e, HTTPException):
+            raise e
+        record_error(e)
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+    finally:
+        if persist:
+            temp_reaper.release(request_dir)
+
+@app.post("/api/generate/stream")
+async def generate_rubric_stream(
+    subject: str = Form(...),
+    question_images: List[UploadFile] = File(...),
+    rubrics_images: List[UploadFile] = File(...),
+    solution_images: List[UploadFile] = File(...),
+    persist: Optional[bool] = Form(None)
+):
+    """
+    Generate rubric from uploaded images, streaming each criterion as
+    newline-delimited JSON as soon as the model has produced it.
+    """
+    # Validate subject
+    valid_subjects = prompt_registry.subjects()
+    if subject.lower() not in valid_subjects:
+        raise HTTPException(status_code=400, detail=f"Invalid subject. Must be one of: {valid_subjects}")
+
+    all_files = [question_images, rubrics_images, solution_images]
+    file_types = ["question", "rubrics", "solution"]
+    validate_uploads(all_files, file_types)
+
+    if persist is None:
+        persist = PERSIST_UPLOADS
+
+    request_id = str(uuid.uuid4())
+    request_dir = f"{TEMP_DIR}/{request_id}"
+
+    if persist:
+        temp_reaper.open_request_dir(request_dir)
+        try:
+            image_sources = await run_in_threadpool(save_uploads, request_dir, all_files, file_types)
+        except Exception as e:
+            temp_reaper.discard(request_dir)
+            raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+    else:
+        # The response body outlives this handler, so copy the upload buffers
+        # into memory instead of relying on the upload files staying open
+        image_sources = [io.BytesIO(await file.read()) for file_list in all_files for file in file_list]
+
+    return StreamingResponse(
+        stream_rubric_events(image_sources, subject.lower(), request_id, request_dir if persist else None,
+                             preview_urls(image_sources) if persist else None),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/generate/batch")
+async def generate_rubric_batch(
+    request: Request,
+    manifest: str = Form(...),
+    files: List[UploadFile] = File(...),
+    subject: Optional[str] = Form(None),
+    persist: Optional[bool] = Form(None)
+):
+    """
+    Generate rubrics for many questions in one request.
+    `manifest` is a JSON list of items that reference uploads in `files` by
+    filename (see parse_batch_manifest). Items run concurrently and failures
+    are reported per item instead of failing the whole batch.
+    """
+    items = parse_batch_manifest(manifest, subject)
+    valid_subjects = prompt_registry.subjects()
+
+    # Admission took one token; the remaining items are charged against the client's bucket
+    client, _ = request_client.get()
+    rate_limiter.charge(client, getattr(request.state, "client_policy", rate_limiter.default_policy), len(items) - 1)
+
+    if persist is None:
+        persist = PERSIST_UPLOADS
+
+    request_id = str(uuid.uuid4())
+    request_dir = f"{TEMP_DIR}/{request_id}"
+    if persist:
+        temp_reaper.open_request_dir(request_dir)
+
+    try:
+        sources = await run_in_threadpool(read_batch_uploads, files, request_dir if persist else None)
+    except Exception as e:
+        if persist and os.path.exists(request_dir):
+            temp_reaper.discard(request_dir)
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+    batch_semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    async def run_item(item: dict) -> dict:
+        async with batch_semaphore:
+            try:
+                item_sources = resolve_batch_item(item, sources, valid_subjects)
+                rubric_result, cache_hit, validation = await get_rubric_async(item_sources, item["subject"])
+                return {
+                    "id": item["id"],
+                    "status": "ok",
+                    "subject": item["subject"],
+                    "rubric": rubric_result,
+                    "cached": cache_hit,
+                    "validation": validation
+                }
+            except HTTPException as e:
+                return {"id": item["id"], "status": "error", "subject": item["subject"],
+                        "status_code": e.status_code, "error": e.detail}
+            except Exception as e:
+                print(f"Error generating rubric for batch item {item['id']}: {e}")
+                return {"id": item["id"], "status": "error", "subject": item["subject"],
+                        "status_code": 500, "error": f"Error processing request: {str(e)}"}
+
+    try:
+        results = await asyncio.gather(*(run_item(item) for item in items))
+    finally:
+        if persist:
+            temp_reaper.release(request_dir)
+    succeeded = sum(1 for result in results if result["status"] == "ok")
+
+    return {
+        "request_id": request_id,
+        "results": results,
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded
+    }
+
+@app.post("/api/jobs", status_code=202)
+async def create_rubric_job(
+    subject: str = Form(...),
+    question_images: List[UploadFile] = File(...),
+    rubrics_images: List[UploadFile] = File(...),
+    solution_images: List[UploadFile] = File(...)
+):
+    """
+    Queue rubric generation and return a job id immediately.
+    Poll GET /api/jobs/{job_id} for the result. The job id doubles as the
+    request_id for /api/next and temp file previews.
+    """
+    # Validate subject
+    valid_subjects = prompt_registry.subjects()
+    if subject.lower() not in valid_subjects:
+        raise HTTPException(status_code=400, detail=f"Invalid subject. Must be one of: {valid_subjects}")
+
+    all_files = [question_images, rubrics_images, solution_images]
+    file_types = ["question", "rubrics", "solution"]
+    validate_uploads(all_files, file_types)
+
+    # Jobs outlive the request, so uploads are always saved to temp storage
+    request_id = str(uuid.uuid4())
+    request_dir = f"{TEMP_DIR}/{request_id}"
+    # Released by the job worker once the job has finished
+    temp_reaper.open_request_dir(request_dir)
+
+    try:
+        saved_paths = await run_in_threadpool(save_uploads, request_dir, all_files, file_types)
+        job = await job_queue.submit(request_id, subject.lower(), saved_paths, request_dir)
+    except Exception as e:
+        if os.path.exists(request_dir):
+            temp_reaper.discard(request_dir)
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
+    return {
+        "job_id": job["job_id"],
+        "request_id": request_id,
+        "status": job["status"]
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def get_rubric_job(job_id: str):
+    """
+    Return the status of a rubric job, and its rubric once completed
+    """
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return {**job, "request_id": job["job_id"]}
+
 @app.post("/api/next")
 async def next_question(request_id: str = Form(...)):
     """
     Clear previous session and temp files
     """
+    # Only ever a directory this service created: never a path outside TEMP_DIR
+    try:
+        request_id = str(uuid.UUID(request_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid request_id")
+
     try:
-        request_dir = f"app/storage/temp/{request_id}"
+        request_dir = f"{TEMP_DIR}/{request_id}"
         if os.path.exists(request_dir):
-            shutil.rmtree(request_dir)
+            temp_reaper.discard(request_dir)
         
         return {"message": "Session cleared successfully", "request_id": request_id}
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error clearing session: {str(e)}")
 
+@app.get("/api/storage/stats")
+async def temp_storage_stats():
+    """
+    Report temp storage usage and what the reaper has reclaimed
+    """
+    return temp_reaper.stats
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in (candidate.removeprefix("W/") for candidate in candidates)
+
 @app.get("/storage/temp/{request_id}/{filename}")
-async def serve_temp_file(request_id: str, filename: str):
+async def serve_temp_file(request: Request, request_id: str, filename: str, w: Optional[int] = None):
     """
-    Serve temporary uploaded files for preview
+    Serve temporary uploaded files for preview. Pass w to get the
+    thumbnail at one of THUMBNAIL_WIDTHS instead of the original.
+    Responses carry a strong ETag and honor If-None-Match and Range.
     """
-    file_path = f"app/storage/temp/{request_id}/{filename}"
-    if not os.path.exists(file_path):
+    # Only names this service generated: a UUID directory and a sanitized filename
+    try:
+        uuid.UUID(request_id)
+    except ValueError:
         raise HTTPException(status_code=404, detail="File not found")
-    
-    return FileResponse(file_path)
+    if filename != safe_filename(filename):
+        raise HTTPException(status_code=404, detail="File not found")
+    if w is not None and w not in THUMBNAIL_WIDTHS:
+        raise HTTPException(status_code=400, detail=f"Invalid thumbnail width. Must be one of: {THUMBNAIL_WIDTHS}")
+
+    file_path = f"{TEMP_DIR}/{request_id}/{filename}"
+    media_type = None
+    if w is not None:
+        source_path, file_path, media_type = file_path, thumbnail_path(file_path, w), "image/jpeg"
+        # Asked for before the background write finished (or after it failed)
+        if not os.path.exists(file_path) and os.path.isfile(source_path):
+            await run_in_threadpool(write_thumbnails, source_path)
+
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        # e.g. the thumbs directory
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Uploads and thumbnails are written once, so size and mtime identify the bytes
+    headers = {
+        "ETag": f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"',
+        "Cache-Control": f"private, max-age={PREVIEW_MAX_AGE_SECONDS}, immutable"
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(file_path, headers=headers, media_type=media_type, stat_result=stat_result)
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED_AT
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    if WORKERS > 1:
+        # Multiple worker processes need an import string; they share state
+        # through STORAGE_ROOT and the shared store
+        uvicorn.run(
+            "app.main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=WORKERS,
+            app_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            timeout_graceful_shutdown=SHUTDOWN_DRAIN_SECONDS
+        )
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000, timeout_graceful_shutdown=SHUTDOWN_DRAIN_SECONDS)
\ No newline at end of file
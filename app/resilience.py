@@ -0,0 +1,210 @@
+"""
+Deadlines, retries, circuit breaking and hedging around a model backend.
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional
+
+from app.metrics import Counter, METRICS
+
+MODEL_RETRIES_TOTAL = Counter("rubrics_model_retries_total", "Model call retries by error type", ("type",))
+MODEL_HEDGES_TOTAL = Counter("rubrics_model_hedges_total", "Hedged model calls by outcome", ("outcome",))
+CIRCUIT_OPEN_TOTAL = Counter("rubrics_model_circuit_open_total", "Times the model circuit breaker opened")
+METRICS.extend([MODEL_RETRIES_TOTAL, MODEL_HEDGES_TOTAL, CIRCUIT_OPEN_TOTAL])
+
+class CircuitOpenError(Exception):
+    """Raised when the model circuit breaker is open and calls are short-circuited"""
+
+class ResilientModelClient:
+    """
+    Wraps a model client's generate_content with a per-call deadline,
+    exponential backoff with jitter for retryable errors, a circuit breaker
+    and optional hedged requests. Works with any object that has a
+    generate_content(content, stream=False, timeout=None) method, e.g. a
+    local fake. timeout is what is left of the deadline; the client must
+    give up after it, so abandoned attempts free their worker thread.
+    """
+
+    RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+    def __init__(self, client, timeout_seconds: float, max_retries: int, base_delay: float, max_delay: float,
+                 failure_threshold: int, reset_seconds: float, hedge: bool = False,
+                 hedge_after_seconds: Optional[float] = None, max_workers: int = 8):
+        self.client = client
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.hedge = hedge
+        self.hedge_after_seconds = hedge_after_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-call")
+        self._latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._half_open_trial = False
+
+    @classmethod
+    def is_retryable(cls, e: Exception) -> bool:
+        """Timeouts, connection errors and 408/429/5xx API errors are retried"""
+        if isinstance(e, (TimeoutError, ConnectionError)):
+            return True
+        code = getattr(e, "code", None)
+        return isinstance(code, int) and code in cls.RETRYABLE_CODES
+
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._half_open_trial:
+                raise CircuitOpenError("Model backend is temporarily unavailable (circuit open)")
+            # Half-open: let a single trial call through
+            self._half_open_trial = True
+
+    def _record_success(self, elapsed: Optional[float] = None):
+        with self._lock:
+            if elapsed is not None:
+                self._latencies.append(elapsed)
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._half_open_trial = False
+
+    def _record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._half_open_trial or self._consecutive_failures >= self.failure_threshold:
+                if self._opened_at is None or self._half_open_trial:
+                    CIRCUIT_OPEN_TOTAL.inc()
+                self._opened_at = time.monotonic()
+                self._half_open_trial = False
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before firing a hedged duplicate call, or None to not hedge"""
+        if not self.hedge:
+            return None
+        if self.hedge_after_seconds is not None:
+            return self.hedge_after_seconds
+        with self._lock:
+            if len(self._latencies) < 20:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def _call_client(self, content, deadline: float, **kwargs):
+        """Call the wrapped client with the time left before deadline"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            # Queued behind other calls until the caller gave up on it
+            raise TimeoutError(f"Model call exceeded {self.timeout_seconds}s deadline")
+        return self.client.generate_content(content, timeout=remaining, **kwargs)
+
+    def _attempt(self, content, deadline: Optional[float] = None, **kwargs):
+        """One call with a deadline; hedged when enabled and not streaming"""
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout_seconds
+        futures = [self._executor.submit(self._call_client, content, deadline, **kwargs)]
+
+        hedge_after = None if kwargs.get("stream") else self.hedge_delay()
+        if hedge_after is not None and hedge_after < self.timeout_seconds:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                MODEL_HEDGES_TOTAL.inc("fired")
+                futures.append(self._executor.submit(self._call_client, content, deadline, **kwargs))
+
+        pending = set(futures)
+        errors = []
+        while pending:
+            remaining = deadline - time.monotonic()
+            done, pending = wait(pending, timeout=max(remaining, 0), return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError(f"Model call exceeded {self.timeout_seconds}s deadline")
+            for future in done:
+                if future.exception() is None:
+                    if len(futures) > 1:
+                        MODEL_HEDGES_TOTAL.inc("primary_won" if future is futures[0] else "hedge_won")
+                    return future.result()
+                errors.append(future.exception())
+        raise errors[0]
+
+    def _retry_delay(self, e: Exception, attempt: int) -> float:
+        MODEL_RETRIES_TOTAL.inc(type(e).__name__)
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        print(f"Retrying model call after {type(e).__name__}: {e} (attempt {attempt + 1}, sleeping {delay:.2f}s)")
+        return delay
+
+    def _stream(self, content, retry_timeouts: bool = True, **kwargs):
+        """
+        Streamed call. The deadline covers opening the stream and reading every
+        chunk, and success or failure is recorded when the stream ends. A call
+        is only retried if it failed before any chunk reached the caller.
+        """
+        end = object()
+        attempt = 0
+        while True:
+            self._before_call()
+            started = time.monotonic()
+            deadline = started + self.timeout_seconds
+            received = False
+            try:
+                chunks = iter(self._attempt(content, deadline=deadline, **kwargs))
+                while True:
+                    future = self._executor.submit(next, chunks, end)
+                    done, _ = wait([future], timeout=max(deadline - time.monotonic(), 0))
+                    if not done:
+                        raise TimeoutError(f"Model call exceeded {self.timeout_seconds}s deadline")
+                    chunk = future.result()
+                    if chunk is end:
+                        break
+                    received = True
+                    yield chunk
+            except GeneratorExit:
+                # The caller stopped reading; the backend itself was healthy
+                self._record_success()
+                raise
+            except Exception as e:
+                if not self.is_retryable(e):
+                    self._record_success()
+                    raise
+                self._record_failure()
+                # Chunks already handed to the caller cannot be taken back
+                if received or attempt >= self.max_retries or (isinstance(e, TimeoutError) and not retry_timeouts):
+                    raise
+                time.sleep(self._retry_delay(e, attempt))
+                attempt += 1
+                continue
+            self._record_success(time.monotonic() - started)
+            return
+
+    def generate_content(self, content, retry_timeouts: bool = True, **kwargs):
+        """
+        Call the wrapped client's generate_content with retries, deadline and circuit breaker.
+        With retry_timeouts=False a timeout is raised after one deadline, for
+        callers that have a faster way out (e.g. a fallback model).
+        """
+        if kwargs.get("stream"):
+            return self._stream(content, retry_timeouts, **kwargs)
+
+        attempt = 0
+        while True:
+            self._before_call()
+            started = time.monotonic()
+            try:
+                response = self._attempt(content, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # The backend answered; a bad request should not trip the breaker
+                    self._record_success()
+                    raise
+                self._record_failure()
+                if attempt >= self.max_retries or (isinstance(e, TimeoutError) and not retry_timeouts):
+                    raise
+                time.sleep(self._retry_delay(e, attempt))
+                attempt += 1
+                continue
+            self._record_success(time.monotonic() - started)
+            return response
@@ -0,0 +1,203 @@
+"""
+Per-request model selection with fallback, and latency, token and cost
+accounting per route.
+"""
+import json
+import threading
+import time
+from typing import Callable, List, Optional
+
+from app.metrics import Counter, Histogram, METRICS
+from app.resilience import CircuitOpenError, ResilientModelClient
+from app.uploads import ImageSource, image_source_size
+
+ROUTE_SECONDS = Histogram("rubrics_model_route_duration_seconds", "Model call latency by route", ("route", "model", "outcome"))
+ROUTE_TOKENS_TOTAL = Counter("rubrics_model_route_tokens_total", "Tokens used by route", ("route", "model", "kind"))
+ROUTE_COST_TOTAL = Counter("rubrics_model_route_cost_total", "Estimated model cost by route", ("route", "model"))
+ROUTE_FALLBACKS_TOTAL = Counter("rubrics_model_route_fallbacks_total", "Fallbacks to the secondary model", ("route", "reason"))
+METRICS.extend([ROUTE_SECONDS, ROUTE_TOKENS_TOTAL, ROUTE_COST_TOTAL, ROUTE_FALLBACKS_TOTAL])
+
+class ModelRoute:
+    """
+    One entry of the routing policy. A route matches when every condition
+    it sets holds for the request (subject, solution page count, total
+    image bytes); unset conditions match anything.
+    """
+
+    def __init__(self, name: str, model: str, fallback: Optional[str] = None, subjects: Optional[List[str]] = None,
+                 min_solution_pages: Optional[int] = None, max_solution_pages: Optional[int] = None,
+                 min_total_bytes: Optional[int] = None, max_total_bytes: Optional[int] = None,
+                 input_cost_per_1k: float = 0.0, output_cost_per_1k: float = 0.0):
+        self.name = name
+        self.model = model
+        self.fallback = fallback
+        self.subjects = [subject.lower() for subject in subjects] if subjects else None
+        self.min_solution_pages = min_solution_pages
+        self.max_solution_pages = max_solution_pages
+        self.min_total_bytes = min_total_bytes
+        self.max_total_bytes = max_total_bytes
+        self.input_cost_per_1k = input_cost_per_1k
+        self.output_cost_per_1k = output_cost_per_1k
+
+    def matches(self, subject: str, solution_pages: int, total_bytes: int) -> bool:
+        if self.subjects is not None and subject not in self.subjects:
+            return False
+        if self.min_solution_pages is not None and solution_pages < self.min_solution_pages:
+            return False
+        if self.max_solution_pages is not None and solution_pages > self.max_solution_pages:
+            return False
+        if self.min_total_bytes is not None and total_bytes < self.min_total_bytes:
+            return False
+        if self.max_total_bytes is not None and total_bytes > self.max_total_bytes:
+            return False
+        return True
+
+class ModelRouter:
+    """
+    Picks a model per request from the routing policy, calls it through a
+    per-model ResilientModelClient, falls back to the route's secondary
+    model on timeout (or open circuit) and records latency, tokens and
+    estimated cost per route. client_factory creates the client for a
+    model name the first time it is used.
+    """
+
+    FALLBACK_ERRORS = (TimeoutError, CircuitOpenError)
+
+    def __init__(self, routes: List[ModelRoute], default_route: ModelRoute,
+                 client_factory: Callable[[str], ResilientModelClient]):
+        self.routes = routes
+        self.default_route = default_route
+        self.client_factory = client_factory
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, routes_json: str, default_route: ModelRoute,
+                    client_factory: Callable[[str], ResilientModelClient]) -> "ModelRouter":
+        try:
+            entries = json.loads(routes_json)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid MODEL_ROUTES JSON: {e}")
+        if not isinstance(entries, list):
+            raise ValueError("MODEL_ROUTES must be a JSON list")
+        routes = [ModelRoute(**{"name": f"route-{i + 1}", **entry}) for i, entry in enumerate(entries)]
+        return cls(routes, default_route, client_factory)
+
+    def validate_subjects(self, subjects: List[str]):
+        """Warn about routes that name subjects missing from the prompt registry"""
+        for route in self.routes:
+            for subject in route.subjects or []:
+                if subject not in subjects:
+                    print(f"Model route {route.name} references unknown subject: {subject}")
+
+    def select(self, subject: str, images: List[ImageSource]) -> ModelRoute:
+        """Pick the first route matching the subject, solution page count and total image bytes"""
+        solution_pages = max(len(images) - 2, 0)
+        total_bytes = sum(image_source_size(source) for source in images)
+        for route in self.routes:
+            if route.matches(subject, solution_pages, total_bytes):
+                return route
+        return self.default_route
+
+    def client(self, model: str) -> ResilientModelClient:
+        """Return the (lazily created) client for a model"""
+        with self._lock:
+            if model not in self._clients:
+                self._clients[model] = self.client_factory(model)
+            return self._clients[model]
+
+    def _record_usage(self, route: ModelRoute, model: str, usage):
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+        cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+        output_tokens = getattr(usage, "candidates_token_count", 0) or 0
+        # prompt_token_count includes the tokens served from a cached context
+        ROUTE_TOKENS_TOTAL.inc(route.name, model, "input", amount=prompt_tokens - cached_tokens)
+        ROUTE_TOKENS_TOTAL.inc(route.name, model, "cached_input", amount=cached_tokens)
+        ROUTE_TOKENS_TOTAL.inc(route.name, model, "output", amount=output_tokens)
+        cost = prompt_tokens / 1000 * route.input_cost_per_1k + output_tokens / 1000 * route.output_cost_per_1k
+        ROUTE_COST_TOTAL.inc(route.name, model, amount=cost)
+
+    @staticmethod
+    def has_fallback(route: ModelRoute) -> bool:
+        return bool(route.fallback) and route.fallback != route.model
+
+    def _call(self, route: ModelRoute, model: str, content, stream: bool, context: Optional[str],
+              retry_timeouts: bool = True):
+        started = time.perf_counter()
+        try:
+            response = self.client(model).generate_content(content, retry_timeouts=retry_timeouts, stream=stream,
+                                                           context=context)
+        except Exception as e:
+            ROUTE_SECONDS.observe(route.name, model, type(e).__name__, value=time.perf_counter() - started)
+            raise
+
+        if not stream:
+            ROUTE_SECONDS.observe(route.name, model, "ok", value=time.perf_counter() - started)
+            self._record_usage(route, model, getattr(response, "usage_metadata", None))
+            return response
+
+        def chunks():
+            usage = None
+            try:
+                for chunk in response:
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    yield chunk
+            except Exception as e:
+                ROUTE_SECONDS.observe(route.name, model, type(e).__name__, value=time.perf_counter() - started)
+                raise
+            ROUTE_SECONDS.observe(route.name, model, "ok", value=time.perf_counter() - started)
+            self._record_usage(route, model, usage)
+
+        return chunks()
+
+    def generate_content(self, route: ModelRoute, content, stream: bool = False, context: Optional[str] = None):
+        """
+        Call the route's model, switching to its fallback model on timeout.
+        A primary model with a fallback gets one deadline, without timeout
+        retries, so the fallback is tried after a single deadline.
+        context is the static prefix of the prompt; backends send it as a cached context.
+        """
+        if stream:
+            return self._stream(route, content, context)
+        try:
+            return self._call(route, route.model, content, stream, context, retry_timeouts=not self.has_fallback(route))
+        except self.FALLBACK_ERRORS as e:
+            if not self.has_fallback(route):
+                raise
+            ROUTE_FALLBACKS_TOTAL.inc(route.name, type(e).__name__)
+            print(f"Falling back from {route.model} to {route.fallback} on route {route.name}: {e}")
+            return self._call(route, route.fallback, content, stream, context)
+
+    def _stream(self, route: ModelRoute, content, context: Optional[str]):
+        """Streamed call; errors surface while reading, so fall back only if no chunk was sent yet"""
+        received = False
+        try:
+            for chunk in self._call(route, route.model, content, True, context, retry_timeouts=not self.has_fallback(route)):
+                received = True
+                yield chunk
+            return
+        except self.FALLBACK_ERRORS as e:
+            if received or not self.has_fallback(route):
+                raise
+            ROUTE_FALLBACKS_TOTAL.inc(route.name, type(e).__name__)
+            print(f"Falling back from {route.model} to {route.fallback} on route {route.name}: {e}")
+        yield from self._call(route, route.fallback, content, True, context)
+
+    def warm_up(self):
+        """Construct the default model's client and backend ahead of the first request"""
+        self.client(self.default_route.model).client.warm_up()
+
+    def ping(self):
+        """Check the default model's backend is reachable"""
+        self.client(self.default_route.model).client.ping()
+
+    def release_contexts(self):
+        """Delete the cached contexts held by every model's backend"""
+        with self._lock:
+            clients = list(self._clients.values())
+        for client in clients:
+            context_cache = getattr(client.client, "context_cache", None)
+            if context_cache is not None:
+                context_cache.close()
@@ -1,3 +1,7 @@
+// Uploads at least this large are previewed from server thumbnails: keeping a
+// full-size phone photo decoded for a small preview costs more than a thumbnail
+const SERVER_PREVIEW_MIN_BYTES = 2 * 1024 * 1024;
+
 // Global state
 let currentSubject = 'math';
 let currentRequestId = null;
@@ -133,13 +137,12 @@ function createFilePreview(file, type, index) {
     const preview = document.createElement('div');
     preview.className = 'file-preview';
     
+    // Show the local file until the server's thumbnails are available
     const img = document.createElement('img');
-    const reader = new FileReader();
-    
-    reader.onload = function(e) {
-        img.src = e.target.result;
+    img.src = URL.createObjectURL(file);
+    img.onload = function() {
+        URL.revokeObjectURL(img.src);
     };
-    reader.readAsDataURL(file);
     
     const fileName = document.createElement('div');
     fileName.className = 'file-name';
@@ -206,6 +209,11 @@ async function generateRubrics() {
     try {
         const formData = new FormData();
         formData.append('subject', currentSubject);
+        // Only keep the uploads on the server when some preview needs its thumbnails
+        const allFiles = [...uploadedFiles.question, ...uploadedFiles.rubrics, ...uploadedFiles.solution];
+        if (allFiles.some(file => file.size >= SERVER_PREVIEW_MIN_BYTES)) {
+            formData.append('persist', 'true');
+        }
         
         // Add files to form data
         uploadedFiles.question.forEach(file => {
@@ -220,7 +228,7 @@ async function generateRubrics() {
             formData.append('solution_images', file);
         });
         
-        const response = await fetch('/api/generate', {
+        const response = await fetch('/api/generate/stream', {
             method: 'POST',
             body: formData
         });
@@ -230,10 +238,8 @@ async function generateRubrics() {
             throw new Error(errorData.detail || 'Failed to generate rubrics');
         }
         
-        const data = await response.json();
-        currentRequestId = data.request_id;
-        
-        displayRubrics(data.rubric);
+        rubricOutput.innerHTML = '';
+        await readRubricStream(response);
         
         // Show results and next button
         results.style.display = 'block';
@@ -248,6 +254,102 @@ async function generateRubrics() {
     }
 }
 
+async function readRubricStream(response) {
+    // The server sends one JSON event per line: start, criterion..., done/error
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (value) {
+            buffer += decoder.decode(value, { stream: true });
+        }
+        
+        let newline;
+        while ((newline = buffer.indexOf('\n')) >= 0) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (line) {
+                handleRubricEvent(JSON.parse(line));
+            }
+        }
+        
+        if (done) {
+            break;
+        }
+    }
+}
+
+function handleRubricEvent(event) {
+    switch (event.event) {
+        case 'start':
+            currentRequestId = event.request_id;
+            if (event.previews) {
+                applyServerPreviews(event.previews);
+            }
+            break;
+        case 'criterion':
+            // Show results as soon as the first criterion arrives
+            loading.style.display = 'none';
+            results.style.display = 'block';
+            appendRubricItem(event.item);
+            break;
+        case 'reset':
+            // The streamed criteria were discarded; the done event carries the final rubric
+            rubricOutput.innerHTML = '';
+            break;
+        case 'done':
+            // done.rubric is authoritative and replaces whatever was streamed
+            currentRequestId = event.request_id;
+            displayRubrics(event.rubric);
+            if (event.validation === 'total_mismatch') {
+                showError('The criterion scores do not add up to the stated total. Please check the rubric.');
+            }
+            break;
+        case 'error':
+            throw new Error(event.detail || 'Failed to generate rubrics');
+    }
+}
+
+function applyServerPreviews(previews) {
+    // Swap each large local preview for the server thumbnails, letting the browser pick a width
+    const indexes = { question: 0, rubrics: 0, solution: 0 };
+    previews.forEach(preview => {
+        const index = indexes[preview.type]++;
+        const file = (uploadedFiles[preview.type] || [])[index];
+        const container = getPreviewContainer(preview.type);
+        if (!file || file.size < SERVER_PREVIEW_MIN_BYTES || !container) {
+            return;
+        }
+        const img = container.querySelectorAll('.file-preview img')[index];
+        const widths = Object.keys(preview.thumbnails);
+        if (!img || !widths.length) {
+            return;
+        }
+        img.srcset = widths.map(width => `${preview.thumbnails[width]} ${width}w`).join(', ');
+        img.sizes = '120px';
+        img.src = preview.thumbnails[widths[0]];
+    });
+}
+
+function appendRubricItem(item) {
+    const rubricItem = document.createElement('div');
+    rubricItem.className = 'rubric-item';
+    
+    const criteria = document.createElement('div');
+    criteria.className = 'criteria';
+    criteria.textContent = item.Criteria;
+    
+    const score = document.createElement('div');
+    score.className = 'score';
+    score.textContent = `Score: ${item.score}`;
+    
+    rubricItem.appendChild(criteria);
+    rubricItem.appendChild(score);
+    rubricOutput.appendChild(rubricItem);
+}
+
 function displayRubrics(rubricData) {
     rubricOutput.innerHTML = '';
     
@@ -256,22 +358,7 @@ function displayRubrics(rubricData) {
         return;
     }
     
-    rubricData.forEach((item, index) => {
-        const rubricItem = document.createElement('div');
-        rubricItem.className = 'rubric-item';
-        
-        const criteria = document.createElement('div');
-        criteria.className = 'criteria';
-        criteria.textContent = item.Criteria;
-        
-        const score = document.createElement('div');
-        score.className = 'score';
-        score.textContent = `Score: ${item.score}`;
-        
-        rubricItem.appendChild(criteria);
-        rubricItem.appendChild(score);
-        rubricOutput.appendChild(rubricItem);
-    });
+    rubricData.forEach(item => appendRubricItem(item));
 }
 
 async function nextQuestion() {
@@ -0,0 +1,156 @@
+"""
+Shared key-value stores for session state and cached results, usable by
+several worker processes (and hosts, for FileKVStore on a shared mount).
+"""
+import json
+import os
+import re
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from typing import Optional
+
+class FileKVStore:
+    """
+    Shared key-value store backed by one JSON file per key. Safe across
+    processes (atomic replace) and across hosts when the directory is on a
+    shared mount. Keys must be filename-safe.
+    """
+
+    KEY_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        if not self.KEY_PATTERN.match(key):
+            raise ValueError(f"Invalid store key: {key}")
+        return os.path.join(self.root, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the stored value, or None if missing or expired"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or "value" not in entry:
+            return None
+        if entry.get("expires_at") is not None and entry["expires_at"] < time.time():
+            self.delete(key)
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value: str, ttl_seconds: Optional[float] = None):
+        """Store a value, optionally expiring after ttl_seconds"""
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        entry = {"value": value, "expires_at": time.time() + ttl_seconds if ttl_seconds is not None else None}
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, prefix: str = "", max_entries: int = 0) -> int:
+        """
+        Delete expired entries, then the least recently written entries whose
+        key starts with prefix beyond max_entries (0 = no cap).
+        Returns the number of entries deleted.
+        """
+        now = time.time()
+        expired = []
+        kept = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    with open(entry.path, "r", encoding="utf-8") as f:
+                        expires_at = json.load(f).get("expires_at")
+                    mtime = entry.stat().st_mtime
+                except (OSError, ValueError, AttributeError):
+                    continue
+                if expires_at is not None and expires_at < now:
+                    expired.append(entry.path)
+                elif entry.name.startswith(prefix):
+                    kept.append((mtime, entry.path))
+
+        if max_entries > 0 and len(kept) > max_entries:
+            kept.sort()
+            expired.extend(path for _, path in kept[:len(kept) - max_entries])
+
+        removed = 0
+        for path in expired:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+class SqliteKVStore:
+    """
+    Local stand-in for a networked KV store (e.g. Redis), shared by all
+    worker processes on one host through a SQLite database in WAL mode.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the stored value, or None if missing or expired"""
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < time.time():
+                conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+                return None
+            return row[0]
+
+    def set(self, key: str, value: str, ttl_seconds: Optional[float] = None):
+        """Store a value, optionally expiring after ttl_seconds"""
+        expires_at = time.time() + ttl_seconds if ttl_seconds is not None else None
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+
+    def delete(self, key: str):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def sweep(self, prefix: str = "", max_entries: int = 0) -> int:
+        """
+        Delete expired entries, then the least recently written entries whose
+        key starts with prefix beyond max_entries (0 = no cap).
+        Returns the number of entries deleted.
+        """
+        with closing(self._connect()) as conn, conn:
+            removed = conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),)).rowcount
+            if max_entries > 0:
+                # INSERT OR REPLACE gives a rewritten key a new, highest rowid
+                removed += conn.execute(
+                    "DELETE FROM kv WHERE rowid IN (SELECT rowid FROM kv WHERE substr(key, 1, ?) = ? "
+                    "ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+                    (len(prefix), prefix, max_entries)
+                ).rowcount
+            return removed
@@ -0,0 +1,231 @@
+"""
+Upload handling: image sources, shared readers for batch uploads, and
+limits enforced while a multipart body streams in.
+"""
+import io
+import os
+import threading
+from typing import BinaryIO, Union
+
+import PIL.Image
+import PIL.features
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# An image is either a saved file path or a seekable binary upload buffer
+ImageSource = Union[str, BinaryIO]
+
+def image_source_size(source: ImageSource) -> int:
+    """Return the size in bytes of a saved image or upload buffer"""
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    source.seek(0, os.SEEK_END)
+    return source.tell()
+
+def iter_image_source(source: ImageSource, chunk_size: int = 1024 * 1024):
+    """Yield the raw bytes of a saved image or upload buffer in chunks"""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            yield from iter(lambda: f.read(chunk_size), b"")
+    else:
+        source.seek(0)
+        yield from iter(lambda: source.read(chunk_size), b"")
+
+def open_image_source(source: ImageSource) -> PIL.Image.Image:
+    """Open a saved image or upload buffer with PIL (without copying it)"""
+    if not isinstance(source, str):
+        source.seek(0)
+    return PIL.Image.open(source)
+
+class SharedUploadReader(io.RawIOBase):
+    """
+    Independent read position over an upload buffer shared by several
+    batch items. Reads seek and read under the buffer's lock, so concurrent
+    items can share one spooled upload without copying it into memory.
+    """
+
+    def __init__(self, file: BinaryIO, lock: threading.Lock):
+        super().__init__()
+        self._file = file
+        self._lock = lock
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        with self._lock:
+            self._file.seek(self._position)
+            data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_END:
+            with self._lock:
+                offset += self._file.seek(0, os.SEEK_END)
+        elif whence == os.SEEK_CUR:
+            offset += self._position
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+# Only formats this Pillow build decodes: (offset, signature, optional Pillow feature it needs).
+# HEIC is left out, since Pillow cannot open it without a plugin
+IMAGE_SIGNATURES = tuple((offset, signature) for offset, signature, feature in (
+    (0, b"\x89PNG\r\n\x1a\n", None),
+    (0, b"\xff\xd8\xff", None),
+    (0, b"GIF87a", None),
+    (0, b"GIF89a", None),
+    (0, b"BM", None),
+    (0, b"II*\x00", None),
+    (0, b"MM\x00*", None),
+    (8, b"WEBP", "webp"),
+    (4, b"ftypavif", "avif"),
+) if feature is None or PIL.features.check(feature))
+IMAGE_SNIFF_BYTES = 16
+
+def sniff_image(header: bytes) -> bool:
+    """Check the leading bytes of a file against known image signatures"""
+    for offset, signature in IMAGE_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            if signature == b"WEBP" and not header.startswith(b"RIFF"):
+                continue
+            return True
+    return False
+
+class UploadGuard:
+    """
+    Follows a multipart body as it is received and rejects it as soon as it
+    breaks a limit: total bytes, bytes per file, number of files, or a file
+    whose leading bytes are not a known image format.
+    """
+
+    def __init__(self, boundary: bytes, max_request_bytes: int, max_file_bytes: int, max_pages: int):
+        self.max_request_bytes = max_request_bytes
+        self.max_file_bytes = max_file_bytes
+        self.max_pages = max_pages
+        self.received = 0
+        self.pages = 0
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._filename = None
+        self._file_bytes = 0
+        self._sniff = b""
+        self._error = None
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _reject(self, status_code: int, detail: str):
+        if self._error is None:
+            self._error = HTTPException(status_code=status_code, detail=detail)
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._filename = None
+        self._file_bytes = 0
+        self._sniff = b""
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"filename" not in options:
+            return
+        self._filename = options[b"filename"].decode("utf-8", "replace")
+        self.pages += 1
+        if self.pages > self.max_pages:
+            self._reject(413, f"Too many images. Maximum is {self.max_pages} per request")
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._filename is None:
+            return
+        self._file_bytes += end - start
+        if self._file_bytes > self.max_file_bytes:
+            self._reject(413, f"Image {self._filename} is too large. Maximum is {self.max_file_bytes} bytes")
+        if len(self._sniff) < IMAGE_SNIFF_BYTES:
+            self._sniff += data[start:min(end, start + IMAGE_SNIFF_BYTES - len(self._sniff))]
+            if len(self._sniff) >= IMAGE_SNIFF_BYTES and not sniff_image(self._sniff):
+                self._reject(400, f"Invalid file type for {self._filename}. Must be an image.")
+
+    def _on_part_end(self):
+        if self._filename is not None and len(self._sniff) < IMAGE_SNIFF_BYTES and not sniff_image(self._sniff):
+            self._reject(400, f"Invalid file type for {self._filename}. Must be an image.")
+
+    def feed(self, chunk: bytes):
+        """Inspect the next body chunk; raises HTTPException once a limit is broken"""
+        self.received += len(chunk)
+        if self.received > self.max_request_bytes:
+            self._reject(413, f"Request too large. Maximum is {self.max_request_bytes} bytes")
+        if self._error is None and chunk:
+            self._parser.write(chunk)
+        if self._error is not None:
+            raise self._error
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware that enforces upload limits on the upload endpoints
+    while the body streams in, before Starlette spools it to memory or disk.
+    limits maps a path to its (max request bytes, max pages).
+    """
+
+    def __init__(self, app, limits: dict, max_file_bytes: int):
+        self.app = app
+        self.limits = limits
+        self.max_file_bytes = max_file_bytes
+
+    async def __call__(self, scope, receive, send):
+        limits = self.limits.get(scope.get("path")) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if limits is None:
+            await self.app(scope, receive, send)
+            return
+
+        max_request_bytes, max_pages = limits
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > max_request_bytes:
+            response = JSONResponse({"detail": f"Request too large. Maximum is {max_request_bytes} bytes"}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        content_type, options = parse_options_header(headers.get(b"content-type", b""))
+        if content_type != b"multipart/form-data" or b"boundary" not in options:
+            await self.app(scope, receive, send)
+            return
+
+        guard = UploadGuard(options[b"boundary"], max_request_bytes, self.max_file_bytes, max_pages)
+
+        async def guarded_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                guard.feed(message.get("body", b""))
+            return message
+
+        await self.app(scope, guarded_receive, send)
@@ -0,0 +1,303 @@
+"""
+Benchmark and load-test harness for the /api/generate pipeline.
+
+Starts the service with the stub model backend (MODEL_BACKEND=stub) in a
+uvicorn subprocess, drives /api/generate at rising concurrency with the
+sample pages in samples/ and with synthetic phone-sized pages, and emits
+the results as JSON. Also micro-benchmarks the get_rubric stages
+(prompt load, image open/preprocess, content assembly) in-process.
+
+Usage (from the repository root):
+    python bench/benchmark.py --levels 1,4,16 --requests 32 --output bench_results.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+import PIL.Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES_DIR = os.path.join(ROOT, "samples")
+TEMP_DIR = os.path.join(ROOT, "app", "storage", "temp")
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def load_sample_pages():
+    """Return (question, rubrics, solution) PNG bytes from samples/"""
+    pages = []
+    for name in ("question_1_q1.png", "rubrics_1_r1.png", "solution_1_s1.png"):
+        with open(os.path.join(SAMPLES_DIR, name), "rb") as f:
+            pages.append((name, f.read(), "image/png"))
+    return pages
+
+
+def make_phone_page(seed: int, size=(4032, 3024)) -> bytes:
+    """Synthetic 12 MP JPEG shaped like a phone photo of a page"""
+    image = PIL.Image.effect_noise(size, 40 + seed).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_phone_pages(solution_pages: int = 2):
+    """Return question, rubrics and solution_pages synthetic phone photos"""
+    pages = [("question.jpg", make_phone_page(0), "image/jpeg"), ("rubrics.jpg", make_phone_page(1), "image/jpeg")]
+    for i in range(solution_pages):
+        pages.append((f"solution_{i + 1}.jpg", make_phone_page(2 + i), "image/jpeg"))
+    return pages
+
+
+def build_files(pages):
+    files = [("question_images", pages[0]), ("rubrics_images", pages[1])]
+    files.extend(("solution_images", page) for page in pages[2:])
+    return files
+
+
+def dir_bytes(path: str) -> int:
+    total = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        try:
+                            total += entry.stat(follow_symlinks=False).st_size
+                        except FileNotFoundError:
+                            pass
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def rss_bytes(pid: int):
+    """Return (current, peak) resident set size of a process, from /proc"""
+    current = peak = None
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return current, peak
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, args) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "MODEL_BACKEND": "stub",
+        "STUB_LATENCY_SECONDS": str(args.stub_latency),
+        "STUB_FAILURE_RATE": str(args.stub_failure_rate),
+        "MAX_CONCURRENT_GENERATIONS": str(args.max_concurrent_generations),
+        "PERSIST_UPLOADS": "true" if args.persist else "false",
+        # Every request must reach the model stage
+        "RESULT_CACHE_SIZE": "0",
+        "RESULT_CACHE_DISK": "false",
+        # All load comes from one client address
+        "RATE_LIMIT_PER_MINUTE": "0",
+    })
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env=env
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Service did not start within 30s")
+
+
+async def run_level(base_url: str, pages, concurrency: int, total_requests: int, pid: int) -> dict:
+    """Send total_requests to /api/generate with at most `concurrency` in flight"""
+    latencies = []
+    errors = {}
+    peak_temp_bytes = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    done = asyncio.Event()
+
+    async def sample_disk():
+        nonlocal peak_temp_bytes
+        while not done.is_set():
+            peak_temp_bytes = max(peak_temp_bytes, dir_bytes(TEMP_DIR))
+            await asyncio.sleep(0.05)
+
+    async def one(client: httpx.AsyncClient):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post("/api/generate", data={"subject": "math"}, files=build_files(pages))
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            if status == 200:
+                latencies.append(elapsed)
+            else:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=limits) as client:
+        sampler = asyncio.create_task(sample_disk())
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client) for _ in range(total_requests)))
+        wall = time.perf_counter() - started
+        done.set()
+        await sampler
+
+    rss, peak_rss = rss_bytes(pid)
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "succeeded": len(latencies),
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else None,
+        "latency_seconds": {
+            "mean": round(statistics.mean(latencies), 4) if latencies else None,
+            "p50": round(percentile(latencies, 50), 4) if latencies else None,
+            "p95": round(percentile(latencies, 95), 4) if latencies else None,
+            "p99": round(percentile(latencies, 99), 4) if latencies else None,
+        },
+        "server_rss_bytes": rss,
+        "server_peak_rss_bytes": peak_rss,
+        "peak_temp_disk_bytes": peak_temp_bytes,
+    }
+
+
+def run_load_test(args) -> dict:
+    port = free_port()
+    process = start_server(port, args)
+    base_url = f"http://127.0.0.1:{port}"
+    datasets = {"samples": load_sample_pages()}
+    if not args.skip_phone:
+        datasets["phone_12mp"] = make_phone_pages(args.phone_solution_pages)
+
+    results = {}
+    try:
+        for name, pages in datasets.items():
+            results[name] = {
+                "upload_bytes": sum(len(page[1]) for page in pages),
+                "pages": len(pages),
+                "levels": [
+                    asyncio.run(run_level(base_url, pages, level, args.requests, process.pid))
+                    for level in args.levels
+                ],
+            }
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return results
+
+
+def time_call(func, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {
+        "repeat": repeat,
+        "mean_ms": round(statistics.mean(timings) * 1000, 4),
+        "p50_ms": round(percentile(timings, 50) * 1000, 4),
+        "p95_ms": round(percentile(timings, 95) * 1000, 4),
+    }
+
+
+def run_micro_benchmarks(args) -> dict:
+    """Time the get_rubric stages in-process, without the HTTP layer or the model"""
+    os.environ.setdefault("MODEL_BACKEND", "stub")
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+    from app import main
+
+    results = {
+        "prompt_load_uncached": time_call(main.load_prompts, args.micro_repeat),
+        "prompt_load_registry": time_call(lambda: main.prompt_registry.get_template("math"), args.micro_repeat),
+    }
+
+    datasets = {"samples": load_sample_pages()}
+    if not args.skip_phone:
+        datasets["phone_12mp"] = make_phone_pages(args.phone_solution_pages)
+
+    template = main.prompt_registry.get_template("math")
+    for name, pages in datasets.items():
+        def open_images():
+            main.load_images([io.BytesIO(page[1]) for page in pages])
+
+        img = main.load_images([io.BytesIO(page[1]) for page in pages])
+        results[f"content_assembly_{name}"] = time_call(lambda: main.build_content(template, img), args.micro_repeat)
+        repeat = max(1, args.micro_repeat // 100) if name == "phone_12mp" else max(1, args.micro_repeat // 10)
+        results[f"image_open_preprocess_{name}"] = time_call(open_images, repeat)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the /api/generate pipeline against the stub model")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level")
+    parser.add_argument("--stub-latency", type=float, default=0.5, help="Stub model latency in seconds")
+    parser.add_argument("--stub-failure-rate", type=float, default=0.0, help="Stub model failure rate (0-1)")
+    parser.add_argument("--max-concurrent-generations", type=int, default=4, help="MAX_CONCURRENT_GENERATIONS for the server")
+    parser.add_argument("--persist", action="store_true", help="Save uploads to temp storage (PERSIST_UPLOADS)")
+    parser.add_argument("--phone-solution-pages", type=int, default=2, help="Solution pages in the synthetic phone dataset")
+    parser.add_argument("--skip-phone", action="store_true", help="Only use the sample PNGs")
+    parser.add_argument("--skip-load", action="store_true", help="Only run the per-stage micro-benchmarks")
+    parser.add_argument("--skip-micro", action="store_true", help="Only run the load test")
+    parser.add_argument("--micro-repeat", type=int, default=200, help="Iterations per micro-benchmark")
+    parser.add_argument("--output", help="Write the JSON results to this file as well as stdout")
+    args = parser.parse_args()
+    args.levels = [int(level) for level in args.levels.split(",") if level]
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+    }
+    if not args.skip_load:
+        report["load"] = run_load_test(args)
+    if not args.skip_micro:
+        report["micro"] = run_micro_benchmarks(args)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Import-time profile of the service, to keep cold starts from regressing.
+
+Imports app.main in fresh interpreters under `python -X importtime`, and
+reports as JSON the module's import time (median over --repeat runs), the
+heaviest modules it imports directly and the modules with the most
+self time. With --max-seconds the script exits non-zero when the median
+import time exceeds the budget, so it can gate CI.
+
+Usage (from the repository root):
+    python bench/import_profile.py --repeat 5 --max-seconds 1.0 --output import_profile.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE = "app.main"
+
+
+def parse_importtime(stderr: str):
+    """Return [(self_us, cumulative_us, depth, module)] from -X importtime output"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|", 2)
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return entries
+
+
+def profile_once(env: dict) -> dict:
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {MODULE} failed:\n{completed.stderr[-2000:]}")
+
+    entries = parse_importtime(completed.stderr)
+    index = next(i for i, entry in enumerate(entries) if entry[3] == MODULE and entry[2] == 0)
+    # Direct imports are printed before the module at depth 1, after the previous top-level entry
+    start = max((i for i, entry in enumerate(entries[:index]) if entry[2] == 0), default=-1) + 1
+    direct = [entry for entry in entries[start:index] if entry[2] == 1]
+    return {
+        "process_seconds": wall,
+        "import_seconds": entries[index][1] / 1e6,
+        "direct": {name: cumulative / 1e6 for _, cumulative, _, name in direct},
+        "self": {name: self_us / 1e6 for self_us, _, _, name in entries},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Profile the import time of {MODULE}")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to import in")
+    parser.add_argument("--top", type=int, default=15, help="Modules to list per ranking")
+    parser.add_argument("--max-seconds", type=float, help="Fail if the median import time exceeds this")
+    parser.add_argument("--output", help="Write the JSON report to this file as well as stdout")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("MODEL_BACKEND", "stub")
+    runs = [profile_once(env) for _ in range(args.repeat)]
+
+    def median_of(key):
+        return round(statistics.median(run[key] for run in runs), 4)
+
+    def ranking(key):
+        names = set().union(*(run[key] for run in runs))
+        medians = {name: statistics.median(run[key].get(name, 0.0) for run in runs) for name in names}
+        ordered = sorted(medians.items(), key=lambda item: item[1], reverse=True)[:args.top]
+        return [{"module": name, "seconds": round(seconds, 4)} for name, seconds in ordered]
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "module": MODULE,
+        "repeat": args.repeat,
+        "import_seconds": median_of("import_seconds"),
+        "process_seconds": median_of("process_seconds"),
+        "heaviest_direct_imports": ranking("direct"),
+        "heaviest_self_time": ranking("self"),
+    }
+    if args.max_seconds is not None:
+        report["max_seconds"] = args.max_seconds
+        report["within_budget"] = report["import_seconds"] <= args.max_seconds
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    if args.max_seconds is not None and not report["within_budget"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
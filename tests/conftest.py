@@ -0,0 +1,11 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.main resolves its static, template and storage paths from the repository root
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MODEL_BACKEND", "stub")
+# Every TestClient request comes from the same client; keep the suite under its bucket
+os.environ.setdefault("RATE_LIMIT_BURST", "1000")
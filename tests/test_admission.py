@@ -0,0 +1,107 @@
+import asyncio
+import json
+
+import pytest
+
+from app.main import ClientPolicy, FairScheduler, TokenBucketLimiter
+
+
+def make_limiter(rate_per_minute=60, burst=2):
+    return TokenBucketLimiter({}, ClientPolicy(rate_per_minute=rate_per_minute, burst=burst))
+
+
+def test_admits_burst_then_reports_retry_after():
+    limiter = make_limiter()
+    policy = limiter.default_policy
+    assert limiter.acquire("a", policy) is None
+    assert limiter.acquire("a", policy) is None
+    retry_after = limiter.acquire("a", policy)
+    assert retry_after == pytest.approx(1.0, abs=0.05)
+    # Other clients have their own bucket
+    assert limiter.acquire("b", policy) is None
+
+
+def test_charge_puts_client_in_debt():
+    limiter = make_limiter()
+    policy = limiter.default_policy
+    assert limiter.acquire("a", policy) is None
+    limiter.charge("a", policy, 4)
+    # One token left after admission, minus four: three tokens of debt plus the one needed
+    assert limiter.acquire("a", policy) == pytest.approx(4.0, abs=0.05)
+
+
+def test_zero_rate_disables_limiting():
+    limiter = make_limiter(rate_per_minute=0)
+    assert all(limiter.acquire("a", limiter.default_policy) is None for _ in range(100))
+
+
+def test_limits_are_split_across_workers():
+    limiter = TokenBucketLimiter.from_config(json.dumps({"key": {"name": "school", "rate_per_minute": 120, "burst": 40}}),
+                                             workers=4)
+    client, policy = limiter.identify("key", "10.0.0.1")
+    assert client == "key:school"
+    assert (policy.rate_per_minute, policy.burst) == (30, 10)
+    assert limiter.default_policy.rate_per_minute == ClientPolicy().rate_per_minute / 4
+
+
+def run_scheduler(scenario):
+    return asyncio.run(scenario())
+
+
+def test_fair_queue_interleaves_clients_by_weight():
+    async def scenario():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire("holder")
+        order = []
+
+        async def call(client, weight):
+            await scheduler.acquire(client, weight)
+            order.append(client)
+            scheduler.release()
+
+        # The bulk client queues first, yet the others are not served after all of its calls
+        tasks = [asyncio.create_task(call("bulk", 1.0)) for _ in range(4)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(call("small", 1.0)), asyncio.create_task(call("heavy", 4.0))]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    order = run_scheduler(scenario)
+    assert order.index("heavy") < order.index("small") < 3
+    assert order.count("bulk") == 4
+
+
+def test_cancelled_waiter_does_not_leak_its_slot():
+    async def scenario():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.queue_depth == 0
+        scheduler.release()
+        return scheduler.in_use
+
+    assert run_scheduler(scenario) == 0
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_passed_on():
+    async def scenario():
+        scheduler = FairScheduler(1)
+        await scheduler.acquire("a")
+        first = asyncio.create_task(scheduler.acquire("b"))
+        second = asyncio.create_task(scheduler.acquire("c"))
+        await asyncio.sleep(0)
+        # Grant the slot to the first waiter, then cancel it before it runs
+        scheduler.release()
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.wait_for(second, timeout=1)
+        scheduler.release()
+        return scheduler.in_use
+
+    assert run_scheduler(scenario) == 0
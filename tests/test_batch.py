@@ -0,0 +1,77 @@
+import io
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import PIL.Image
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.uploads import SharedUploadReader
+
+client = TestClient(main.app)
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+@pytest.fixture(autouse=True)
+def model(monkeypatch):
+    def generate_content(route, content, stream=False, context=None):
+        pages = sum(1 for part in content if not isinstance(part, str))
+        return Response(json.dumps([{"Criteria": f"{pages} pages", "score": 1}]))
+
+    monkeypatch.setattr(main.model_router, "generate_content", generate_content)
+    monkeypatch.setattr(main, "rubric_cache", main.RubricCache(max_size=16, ttl_seconds=60))
+
+
+def spooled(data: bytes):
+    file = tempfile.SpooledTemporaryFile(max_size=16)
+    file.write(data)
+    return file
+
+
+def test_readers_share_one_buffer_with_independent_positions():
+    file = spooled(bytes(range(256)) * 64)
+    lock = threading.Lock()
+
+    def read_all(_):
+        reader = SharedUploadReader(file, lock)
+        chunks = []
+        while chunk := reader.read(1000):
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(read_all, range(16)))
+    assert all(result == bytes(range(256)) * 64 for result in results)
+
+
+def test_reader_supports_seek_tell_and_pil():
+    buffer = io.BytesIO()
+    PIL.Image.new("RGB", (32, 16), "red").save(buffer, format="PNG")
+    reader = SharedUploadReader(spooled(buffer.getvalue()), threading.Lock())
+    assert reader.seek(0, io.SEEK_END) == len(buffer.getvalue())
+    reader.seek(0)
+    with PIL.Image.open(reader) as image:
+        assert image.size == (32, 16)
+
+
+def test_batch_items_can_share_in_memory_uploads():
+    with open("samples/question_1_q1.png", "rb") as f:
+        data = f.read()
+    manifest = [
+        {"id": "q1", "subject": "math", "question": ["q.png"], "rubrics": ["r.png"], "solution": ["s.png"]},
+        {"id": "q2", "subject": "math", "question": ["q.png"], "rubrics": ["r.png"], "solution": ["s.png", "s.png"]},
+    ]
+    files = [("files", (name, data, "image/png")) for name in ("q.png", "r.png", "s.png")]
+    response = client.post("/api/generate/batch", data={"manifest": json.dumps(manifest)}, files=files)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["succeeded"] == 2
+    assert [result["rubric"][0]["Criteria"] for result in body["results"]] == ["3 pages", "4 pages"]
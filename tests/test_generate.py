@@ -0,0 +1,59 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+
+client = TestClient(main.app)
+
+MISMATCH = json.dumps([
+    {"Criteria": "Uses Ohm law", "score": 2},
+    {"Criteria": "Total marks", "score": 5}
+])
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+@pytest.fixture(autouse=True)
+def model(monkeypatch):
+    calls = []
+
+    def generate_content(route, content, stream=False, context=None):
+        calls.append(stream)
+        return iter([Response(MISMATCH)]) if stream else Response(MISMATCH)
+
+    monkeypatch.setattr(main.model_router, "generate_content", generate_content)
+    monkeypatch.setattr(main, "rubric_cache", main.RubricCache(max_size=16, ttl_seconds=60))
+    return calls
+
+
+def files():
+    with open("samples/question_1_q1.png", "rb") as f:
+        data = f.read()
+    return [(field, ("page.png", data, "image/png"))
+            for field in ("question_images", "rubrics_images", "solution_images")]
+
+
+def test_total_mismatch_is_reported_and_not_cached(model):
+    for _ in range(2):
+        response = client.post("/api/generate", data={"subject": "math"}, files=files())
+        assert response.status_code == 200
+        body = response.json()
+        assert body["validation"] == "total_mismatch"
+        assert body["cached"] is False
+        assert [criterion["Criteria"] for criterion in body["rubric"]] == ["Uses Ohm law", "Total marks"]
+    # Both requests went to the model: the first generation and one regeneration each
+    assert len(model) == 2 * (main.RUBRIC_MAX_REGENERATIONS + 1)
+
+
+def test_stream_done_event_reports_total_mismatch():
+    response = client.post("/api/generate/stream", data={"subject": "math"}, files=files())
+    done = json.loads(response.text.splitlines()[-1])
+    assert done["event"] == "done"
+    assert done["validation"] == "total_mismatch"
+    assert not main.rubric_cache._entries
@@ -0,0 +1,23 @@
+import io
+import os
+
+import PIL.Image
+
+from app import main
+
+SAMPLE = os.path.join("samples", "question_1_q1.png")
+
+
+def test_preprocessed_pages_are_sent_as_encoded_blobs():
+    [blob] = main.load_images([SAMPLE])
+    assert blob["mime_type"] == PIL.Image.MIME[main.IMAGE_FORMAT]
+    with PIL.Image.open(io.BytesIO(blob["data"])) as image:
+        assert image.format == main.IMAGE_FORMAT
+
+
+def test_unprocessed_pages_keep_the_uploaded_bytes(monkeypatch):
+    monkeypatch.setattr(main, "IMAGE_PREPROCESS", False)
+    with open(SAMPLE, "rb") as f:
+        data = f.read()
+    [blob] = main.load_images([io.BytesIO(data)])
+    assert blob == {"mime_type": "image/png", "data": data}
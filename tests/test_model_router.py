@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+from app.resilience import ResilientModelClient
+from app.routing import ModelRoute, ModelRouter
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class FakeModel:
+    """Local fake backend that answers after a fixed delay, honouring the timeout"""
+
+    def __init__(self, name, delay=0.0):
+        self.name = name
+        self.delay = delay
+        self.calls = 0
+
+    def generate_content(self, content, stream=False, context=None, timeout=None, **kwargs):
+        self.calls += 1
+        if timeout is not None and self.delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"{self.name} timed out")
+        time.sleep(self.delay)
+        return iter([Response(self.name)]) if stream else Response(self.name)
+
+
+def make_router(route, **models):
+    def create_client(name):
+        return ResilientModelClient(models[name], timeout_seconds=0.2, max_retries=2, base_delay=0, max_delay=0,
+                                    failure_threshold=10, reset_seconds=60)
+
+    return ModelRouter([], route, create_client)
+
+
+def test_falls_back_after_one_deadline_without_retrying_the_primary():
+    primary, secondary = FakeModel("primary", delay=5), FakeModel("secondary")
+    route = ModelRoute("default", "primary", fallback="secondary")
+    router = make_router(route, primary=primary, secondary=secondary)
+    started = time.monotonic()
+    assert router.generate_content(route, ["x"]).text == "secondary"
+    assert time.monotonic() - started < 0.5
+    assert primary.calls == 1
+
+
+def test_streamed_call_falls_back_after_one_deadline():
+    primary, secondary = FakeModel("primary", delay=5), FakeModel("secondary")
+    route = ModelRoute("default", "primary", fallback="secondary")
+    router = make_router(route, primary=primary, secondary=secondary)
+    assert [chunk.text for chunk in router.generate_content(route, ["x"], stream=True)] == ["secondary"]
+    assert primary.calls == 1
+
+
+def test_timeouts_are_retried_without_a_fallback():
+    primary = FakeModel("primary", delay=5)
+    route = ModelRoute("default", "primary")
+    router = make_router(route, primary=primary)
+    with pytest.raises(TimeoutError):
+        router.generate_content(route, ["x"])
+    assert primary.calls == 3
@@ -0,0 +1,136 @@
+import threading
+import time
+
+import pytest
+
+from app.resilience import CircuitOpenError, ResilientModelClient
+
+
+class FakeError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"fake error {code}")
+        self.code = code
+
+
+class FakeClient:
+    """Local fake model client: each call pops the next scripted behaviour"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+        self.timeouts = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, content, stream=False, timeout=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.timeouts.append(timeout)
+            step = self.script.pop(0) if self.script else "ok"
+        if isinstance(step, Exception):
+            raise step
+        if isinstance(step, (int, float)):
+            # Hang for step seconds, honouring the timeout like a real HTTP client
+            if timeout is not None and step > timeout:
+                time.sleep(timeout)
+                raise TimeoutError("fake call timed out")
+            time.sleep(step)
+            step = "slow"
+        if stream:
+            return iter([step, "!"])
+        return step
+
+
+def make_client(fake, **overrides):
+    options = dict(timeout_seconds=1.0, max_retries=2, base_delay=0, max_delay=0,
+                   failure_threshold=3, reset_seconds=60, max_workers=4)
+    options.update(overrides)
+    return ResilientModelClient(fake, **options)
+
+
+def test_retries_retryable_errors_then_succeeds():
+    fake = FakeClient(FakeError(503), FakeError(429), "ok")
+    assert make_client(fake).generate_content(["x"]) == "ok"
+    assert fake.calls == 3
+
+
+def test_does_not_retry_other_errors():
+    fake = FakeClient(FakeError(400))
+    with pytest.raises(FakeError):
+        make_client(fake).generate_content(["x"])
+    assert fake.calls == 1
+
+
+def test_gives_up_after_max_retries():
+    fake = FakeClient(*[FakeError(503)] * 5)
+    with pytest.raises(FakeError):
+        make_client(fake, max_retries=1).generate_content(["x"])
+    assert fake.calls == 2
+
+
+def test_circuit_opens_after_threshold_and_half_opens_after_reset():
+    fake = FakeClient(FakeError(503), FakeError(503), "ok")
+    client = make_client(fake, max_retries=0, failure_threshold=2, reset_seconds=0.1)
+    for _ in range(2):
+        with pytest.raises(FakeError):
+            client.generate_content(["x"])
+    with pytest.raises(CircuitOpenError):
+        client.generate_content(["x"])
+    assert fake.calls == 2
+
+    time.sleep(0.15)
+    assert client.generate_content(["x"]) == "ok"
+    assert client.generate_content(["x"]) == "ok"
+
+
+def test_deadline_is_passed_to_the_backend():
+    fake = FakeClient(5)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        make_client(fake, timeout_seconds=0.2, max_retries=0).generate_content(["x"])
+    assert time.monotonic() - started < 1
+    assert 0 < fake.timeouts[0] <= 0.2
+
+
+def test_hung_calls_do_not_starve_later_calls():
+    fake = FakeClient(5, 5)
+    client = make_client(fake, timeout_seconds=0.2, max_retries=0, failure_threshold=10, max_workers=2)
+    threads = [threading.Thread(target=lambda: pytest.raises(TimeoutError, client.generate_content, ["x"]))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The abandoned calls gave up at their own deadline, so both workers are free again
+    assert client.generate_content(["x"]) == "ok"
+
+
+def test_hedged_call_wins_over_slow_primary():
+    fake = FakeClient(0.5, "fast")
+    client = make_client(fake, hedge=True, hedge_after_seconds=0.05)
+    started = time.monotonic()
+    assert client.generate_content(["x"]) == "fast"
+    assert time.monotonic() - started < 0.4
+    assert fake.calls == 2
+
+
+def test_stream_deadline_covers_reading_chunks():
+    class SlowStream(FakeClient):
+        def generate_content(self, content, stream=False, timeout=None, **kwargs):
+            self.calls += 1
+
+            def chunks():
+                yield "first"
+                time.sleep(1)
+                yield "late"
+            return chunks()
+
+    fake = SlowStream()
+    client = make_client(fake, timeout_seconds=0.2, failure_threshold=1)
+    stream = client.generate_content(["x"], stream=True)
+    assert next(stream) == "first"
+    with pytest.raises(TimeoutError):
+        next(stream)
+    # A chunk already reached the caller, so the call is not retried, but it counts as a failure
+    assert fake.calls == 1
+    with pytest.raises(CircuitOpenError):
+        list(client.generate_content(["x"], stream=True))
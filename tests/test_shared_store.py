@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from app.stores import FileKVStore, SqliteKVStore
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "file":
+        return FileKVStore(str(tmp_path / "store"))
+    return SqliteKVStore(str(tmp_path / "store.db"))
+
+
+def age(store, key, seconds):
+    """Backdate a file entry's write time; sqlite entries are ordered by write already"""
+    if isinstance(store, FileKVStore):
+        path = store._path(key)
+        mtime = os.path.getmtime(path) - seconds
+        os.utime(path, (mtime, mtime))
+
+
+def test_sweep_removes_expired_entries(store):
+    store.set("rubric-old", "a", ttl_seconds=-1)
+    store.set("job-old", "b", ttl_seconds=-1)
+    store.set("rubric-new", "c", ttl_seconds=60)
+    store.set("job-forever", "d")
+    assert store.sweep() == 2
+    assert store.get("rubric-new") == "c"
+    assert store.get("job-forever") == "d"
+
+
+def test_sweep_caps_prefixed_entries_oldest_first(store):
+    for i in range(5):
+        store.set(f"rubric-{i}", str(i), ttl_seconds=60)
+        age(store, f"rubric-{i}", 100 - i)
+    store.set("job-1", "job", ttl_seconds=60)
+    assert store.sweep("rubric-", max_entries=2) == 3
+    assert [store.get(f"rubric-{i}") for i in range(5)] == [None, None, None, "3", "4"]
+    assert store.get("job-1") == "job"
+
+
+def test_sweep_without_cap_keeps_live_entries(store):
+    for i in range(3):
+        store.set(f"rubric-{i}", str(i), ttl_seconds=60)
+    assert store.sweep("rubric-") == 0
+    assert store.get("rubric-0") == "0"
@@ -0,0 +1,89 @@
+import os
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+
+client = TestClient(main.app)
+
+
+@pytest.fixture(autouse=True)
+def temp_dir(tmp_path, monkeypatch):
+    root = tmp_path / "temp"
+    root.mkdir()
+    monkeypatch.setattr(main, "TEMP_DIR", str(root))
+    monkeypatch.setattr(main, "temp_reaper", main.TempStorageReaper(str(root), 3600, 1024 * 1024))
+    return root
+
+
+@pytest.fixture
+def request_dir(temp_dir):
+    request_id = str(uuid.uuid4())
+    os.makedirs(temp_dir / request_id / "thumbs")
+    (temp_dir / request_id / "question_1_q.png").write_bytes(b"not really a png")
+    return request_id
+
+
+def test_serves_saved_upload(request_dir):
+    response = client.get(f"/storage/temp/{request_dir}/question_1_q.png")
+    assert response.status_code == 200
+    assert response.content == b"not really a png"
+
+
+def test_directory_is_not_found(request_dir):
+    assert client.get(f"/storage/temp/{request_dir}/thumbs").status_code == 404
+
+
+@pytest.mark.parametrize("request_id", ["../victim", "not-a-uuid", ""])
+def test_next_rejects_non_uuid_request_id(request_id, tmp_path):
+    victim = tmp_path / "victim"
+    victim.mkdir()
+    response = client.post("/api/next", data={"request_id": request_id})
+    assert response.status_code in (400, 422)
+    assert victim.exists()
+
+
+def test_next_discards_request_dir(request_dir):
+    response = client.post("/api/next", data={"request_id": request_dir})
+    assert response.status_code == 200
+    assert not os.path.exists(os.path.join(main.TEMP_DIR, request_dir))
+
+
+def make_request_dir(root, size, age_seconds, active=False):
+    path = root / str(uuid.uuid4())
+    path.mkdir()
+    (path / "upload.png").write_bytes(b"x" * size)
+    if active:
+        (path / main.TempStorageReaper.ACTIVE_MARKER).touch()
+    mtime = os.path.getmtime(path) - age_seconds
+    for item in [path, *path.iterdir()]:
+        os.utime(item, (mtime, mtime))
+    return path
+
+
+def test_quota_eviction_skips_active_and_young_dirs(tmp_path):
+    reaper = main.TempStorageReaper(str(tmp_path), max_age_seconds=3600, quota_bytes=100, min_age_seconds=60)
+    active = make_request_dir(tmp_path, 100, 600, active=True)
+    young = make_request_dir(tmp_path, 100, 10)
+    idle = make_request_dir(tmp_path, 100, 300)
+    reaper.reap()
+    assert active.exists() and young.exists()
+    assert not idle.exists()
+
+
+def test_age_eviction_ignores_stale_active_marker(tmp_path):
+    reaper = main.TempStorageReaper(str(tmp_path), max_age_seconds=3600, quota_bytes=10 ** 9, min_age_seconds=60)
+    stale = make_request_dir(tmp_path, 10, 7200, active=True)
+    reaper.reap()
+    assert not stale.exists()
+
+
+def test_release_clears_the_active_marker(tmp_path):
+    reaper = main.TempStorageReaper(str(tmp_path), max_age_seconds=3600, quota_bytes=100)
+    path = str(tmp_path / "request")
+    reaper.open_request_dir(path)
+    assert os.path.exists(os.path.join(path, reaper.ACTIVE_MARKER))
+    reaper.release(path)
+    assert os.listdir(path) == []
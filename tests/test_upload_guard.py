@@ -0,0 +1,106 @@
+import io
+
+import PIL.Image
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from app import main
+from app.uploads import UploadGuard, sniff_image
+
+BOUNDARY = b"testboundary"
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+HEIC = b"\x00\x00\x00\x18ftypheic" + b"\x00" * 32
+
+client = TestClient(main.app)
+
+
+def multipart(*files, fields=()):
+    body = b""
+    for name, value in fields:
+        body += b"--" + BOUNDARY + b"\r\n"
+        body += f'Content-Disposition: form-data; name="{name}"\r\n\r\n'.encode() + value + b"\r\n"
+    for filename, data in files:
+        body += b"--" + BOUNDARY + b"\r\n"
+        body += f'Content-Disposition: form-data; name="question_images"; filename="{filename}"\r\n'.encode()
+        body += b"Content-Type: image/png\r\n\r\n" + data + b"\r\n"
+    return body + b"--" + BOUNDARY + b"--\r\n"
+
+
+def feed(guard, body, chunk_size=7):
+    # Small chunks, so limits are checked part-way through parts and headers
+    for i in range(0, len(body), chunk_size):
+        guard.feed(body[i:i + chunk_size])
+
+
+def make_guard(max_request_bytes=10_000, max_file_bytes=1_000, max_pages=3):
+    return UploadGuard(BOUNDARY, max_request_bytes, max_file_bytes, max_pages)
+
+
+def test_accepts_images_within_limits():
+    guard = make_guard()
+    feed(guard, multipart(("a.png", PNG), ("b.png", PNG), fields=[("subject", b"math")]))
+    assert guard.pages == 2
+
+
+def test_rejects_oversized_file():
+    with pytest.raises(HTTPException) as e:
+        feed(make_guard(max_file_bytes=100), multipart(("a.png", PNG + b"\x00" * 200)))
+    assert e.value.status_code == 413
+
+
+def test_rejects_oversized_request():
+    with pytest.raises(HTTPException) as e:
+        feed(make_guard(max_request_bytes=300), multipart(*[(f"{i}.png", PNG) for i in range(3)]))
+    assert e.value.status_code == 413
+
+
+def test_rejects_too_many_pages():
+    with pytest.raises(HTTPException) as e:
+        feed(make_guard(max_pages=2), multipart(*[(f"{i}.png", PNG) for i in range(3)]))
+    assert e.value.status_code == 413
+    assert "Too many images" in e.value.detail
+
+
+@pytest.mark.parametrize("data", [b"%PDF-1.7" + b"\x00" * 32, b"GIF", HEIC])
+def test_rejects_files_that_are_not_decodable_images(data):
+    with pytest.raises(HTTPException) as e:
+        feed(make_guard(), multipart(("a.png", data)))
+    assert e.value.status_code == 400
+
+
+def test_sniffs_only_formats_pillow_can_open():
+    assert sniff_image(PNG[:16])
+    assert not sniff_image(HEIC[:16])
+
+
+def test_middleware_rejects_by_content_length():
+    response = client.post("/api/generate", content=b"x",
+                           headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY.decode()}",
+                                    "Content-Length": str(main.UPLOAD_MAX_REQUEST_BYTES + 1)})
+    assert response.status_code == 413
+
+
+def test_middleware_rejects_non_image_upload():
+    files = [(field, ("page.png", b"not an image at all", "image/png"))
+             for field in ("question_images", "rubrics_images", "solution_images")]
+    response = client.post("/api/generate", data={"subject": "math"}, files=files)
+    assert response.status_code == 400
+
+
+def test_undecodable_image_is_a_client_error():
+    # A PNG signature passes the sniffer, but the rest of the file is garbage
+    files = [(field, ("page.png", PNG, "image/png"))
+             for field in ("question_images", "rubrics_images", "solution_images")]
+    response = client.post("/api/generate", data={"subject": "math"}, files=files)
+    assert response.status_code == 400
+    assert "SpooledTemporaryFile" not in response.json()["detail"]
+
+
+def test_decompression_bomb_is_a_client_error(monkeypatch):
+    buffer = io.BytesIO()
+    PIL.Image.new("L", (64, 64)).save(buffer, format="PNG")
+    monkeypatch.setattr(PIL.Image, "MAX_IMAGE_PIXELS", 100)
+    with pytest.raises(HTTPException) as e:
+        main.load_images([buffer])
+    assert e.value.status_code == 400
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from app.main import RubricValidationError, validate_rubric
+
+
+def test_valid_rubric_is_returned_unchanged():
+    rubric, repairs = validate_rubric('[{"Criteria": "a", "score": 1}, {"Criteria": "b", "score": 2}]')
+    assert rubric == [{"Criteria": "a", "score": 1.0}, {"Criteria": "b", "score": 2.0}]
+    assert repairs == []
+
+
+def test_criterion_starting_with_total_is_kept():
+    text = '[{"Criteria": "Uses Ohm law", "score": 2}, {"Criteria": "Total resistance computed correctly", "score": 2}]'
+    rubric, repairs = validate_rubric(text)
+    assert [criterion["Criteria"] for criterion in rubric] == ["Uses Ohm law", "Total resistance computed correctly"]
+    assert repairs == []
+
+
+def test_criterion_starting_with_overall_is_kept():
+    text = '[{"Criteria": "Correct working", "score": 3}, {"Criteria": "Overall presentation and units", "score": 1}]'
+    rubric, _ = validate_rubric(text)
+    assert len(rubric) == 2
+
+
+def test_total_marks_row_is_removed_when_scores_add_up():
+    text = '[{"Criteria": "a", "score": 2}, {"Criteria": "b", "score": 3}, {"Criteria": "Total Marks: 5", "score": 5}]'
+    rubric, repairs = validate_rubric(text)
+    assert rubric == [{"Criteria": "a", "score": 2.0}, {"Criteria": "b", "score": 3.0}]
+    assert repairs == ["total_row"]
+
+
+def test_total_mismatch_keeps_every_row_in_best_effort_rubric():
+    text = '[{"Criteria": "a", "score": 2}, {"Criteria": "Total marks awarded for units", "score": 1}]'
+    with pytest.raises(RubricValidationError) as excinfo:
+        validate_rubric(text)
+    assert len(excinfo.value.rubric) == 2
+
+
+def test_wrapper_total_is_checked():
+    text = json.dumps({"total_marks": 6, "rubric": [{"Criteria": "a", "score": 2}, {"Criteria": "b", "score": 3}]})
+    with pytest.raises(RubricValidationError) as excinfo:
+        validate_rubric(text)
+    assert len(excinfo.value.rubric) == 2
+
+
+def test_truncated_array_keeps_complete_criteria():
+    rubric, repairs = validate_rubric('[{"Criteria": "a", "score": 1}, {"Criteria": "b", "score": 2}, {"Criteria": "c", "sco')
+    assert [criterion["Criteria"] for criterion in rubric] == ["a", "b"]
+    assert repairs == ["truncated"]
+
+
+def test_fenced_output_and_text_scores_are_coerced():
+    rubric, repairs = validate_rubric('```json\n[{"criteria": " a ", "marks": "1.5 marks"}]\n```')
+    assert rubric == [{"Criteria": "a", "score": 1.5}]
+    assert repairs == ["coerced_item", "fenced"]
+
+
+@pytest.mark.parametrize("text", ["garbage", "[]", "null", '[{"Criteria": "", "score": 1}]'])
+def test_unusable_output_raises_without_rubric(text):
+    with pytest.raises(RubricValidationError) as excinfo:
+        validate_rubric(text)
+    assert excinfo.value.rubric is None